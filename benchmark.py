@@ -0,0 +1,384 @@
+"""
+Offline benchmark: replays webhook events and synthetic quiz sessions through tb_webhook.webhook
+against in-memory stand-ins for YDB and the Telegram Bot API.
+
+    python benchmark.py --users 200 --db-latency 5 --tg-latency 30
+    python benchmark.py --events requests.jsonl --json
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+from datetime import datetime
+
+# Бенчмарку не нужны настоящие токен и база: задаем значения до импорта модулей бота
+os.environ.setdefault("API_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("METRICS_LOG_INTERVAL", "0")
+os.environ.setdefault("METRICS_SAMPLE_RATE", "0")
+# Заглушка YDB понимает только запросы к одной строке, результаты квизов держим в памяти
+os.environ.setdefault("RESULTS_BACKEND", "memory")
+# Синтетические пользователи отвечают мгновенно: лимиты Telegram мерили бы только ожидание в очереди.
+# Чтобы измерить сам троттлинг, задайте OUTBOUND_GLOBAL_RATE/OUTBOUND_CHAT_RATE явно
+os.environ.setdefault("OUTBOUND_CHAT_RATE", "0")
+os.environ.setdefault("OUTBOUND_GLOBAL_RATE", "0")
+
+import ydb
+from aiogram import types
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendMessage, EditMessageReplyMarkup, DeleteMessage, AnswerCallbackQuery
+
+import database
+import tb_webhook
+from metrics import metrics
+from middlewares import TelegramTimingMiddleware
+from outbound import sender
+from question_bank import bank
+from question_catalog import AnswerCallback, GroupAnswerCallback
+from state_store import store
+
+
+class FakeRow(dict):
+    # Строки YDB доступны и как словарь, и через атрибуты
+    def __getattr__(self, name):
+        return self.get(name)
+
+
+class FakeResultSet:
+    def __init__(self, rows):
+        self.rows = rows
+
+
+class FakeYdb:
+    """
+    In-memory stand-in for the quiz tables: understands the single-key
+    SELECT/UPSERT/INSERT/UPDATE/DELETE statements and the bulk quiz_state writes the bot issues.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.tables: dict[str, dict] = {}
+        self.executes = 0
+        self.prepares = 0
+
+    def run(self, query: str, params: dict):
+        operation = re.search(r'\b(SELECT|UPSERT|UPDATE|INSERT|DELETE)\b', query, re.I)
+        op = operation.group(1).upper()
+        rest = query[operation.start():]
+        table = (re.search(r'`(\w+)`', rest) or re.search(r'\b(?:FROM|INTO|UPDATE)\s+(\w+)', rest, re.I)).group(1)
+        rows = self.tables.setdefault(table, {})
+
+        if '$rows' in params:
+            # Пакетная запись database.WriteBatcher: UPSERT ... FROM AS_TABLE($rows), с проверкой версий или без
+            checked = 'IS DISTINCT FROM' in rest
+            rejected = []
+            for row in params['$rows']:
+                row = dict(row)
+                expected_version = row.pop('expected_version', None)
+                key = row['user_id']
+                if checked and key in rows and rows[key].get('version') != expected_version:
+                    rejected.append(FakeRow(user_id=key))
+                    continue
+                rows[key] = {**rows.get(key, {}), **row}
+            return [FakeResultSet(rejected)] if checked else []
+
+        if op in ('UPSERT', 'INSERT'):
+            columns = [c.strip(' `') for c in re.search(r'\(([^)]*)\)\s*VALUES', rest, re.I).group(1).split(',')]
+            values = re.search(r'VALUES\s*\((.*)\)\s*;', rest, re.I | re.S).group(1).split(',')
+            record = dict(zip(columns, (self._value(v.strip(), params) for v in values)))
+            key = record[columns[0]]  # первая колонка - первичный ключ
+            if op == 'INSERT' and key in rows:
+                raise ydb.PreconditionFailed(f"Conflict with existing key in {table}")
+            rows[key] = {**rows.get(key, {}), **record}
+            return []
+
+        in_match = re.search(r'WHERE\s+\w+\s+IN\s+\$(\w+)', rest, re.I)
+        if op == 'SELECT' and in_match:
+            return [FakeResultSet([FakeRow(rows[key]) for key in params['$' + in_match.group(1)] if key in rows])]
+
+        key_match = re.search(r'WHERE\s+\w+\s*==\s*\$(\w+)', rest, re.I)
+        key = params['$' + key_match.group(1)]
+        if op == 'SELECT':
+            row = rows.get(key)
+            return [FakeResultSet([FakeRow(row)] if row is not None else [])]
+        if op == 'UPDATE':
+            if key in rows:
+                for column, param in re.findall(r'(\w+)\s*=\s*\$(\w+)', rest.split('WHERE')[0]):
+                    rows[key][column] = params['$' + param]
+            return []
+        rows.pop(key, None)  # DELETE
+        return []
+
+    @staticmethod
+    def _value(token: str, params: dict):
+        if token.startswith('$'):
+            return params[token]
+        if token.isdigit():
+            return int(token)
+        return time.time()  # CurrentUtcTimestamp()
+
+
+class FakeTransaction:
+    def __init__(self, db: FakeYdb):
+        self._db = db
+
+    async def execute(self, query, params=None, commit_tx=False):
+        self._db.executes += 1
+        await asyncio.sleep(self._db.latency)
+        return self._db.run(query, params or {})
+
+    async def rollback(self):
+        pass
+
+
+class FakeSession:
+    _ids = itertools.count(1)
+
+    def __init__(self, db: FakeYdb):
+        self._db = db
+        self.session_id = f"fake-session-{next(self._ids)}"
+
+    async def prepare(self, query: str):
+        self._db.prepares += 1
+        await asyncio.sleep(self._db.latency)
+        return query
+
+    def transaction(self, tx_mode=None):
+        return FakeTransaction(self._db)
+
+
+class FakeSessionPool:
+    def __init__(self, db: FakeYdb, size: int = 50):
+        self._sessions = [FakeSession(db) for _ in range(size)]
+
+    async def retry_operation(self, callee, *args, retry_settings=None, **kwargs):
+        session = random.choice(self._sessions)
+        return await callee(session, *args, **kwargs)
+
+
+class FakeTelegramSession(BaseSession):
+    """
+    Bot API stand-in with latency injection; remembers the last inline keyboard sent to each chat.
+    """
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+        self.calls = 0
+        self.keyboards: dict[int, tuple[int, types.InlineKeyboardMarkup]] = {}
+        self.finished: set[int] = set()  # чаты, в которые пришел итог квиза
+        self._message_ids = itertools.count(1000)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if isinstance(method, SendMessage):
+            message_id = next(self._message_ids)
+            if isinstance(method.reply_markup, types.InlineKeyboardMarkup):
+                self.keyboards[method.chat_id] = (message_id, method.reply_markup)
+            if method.text.startswith(FINISHED_TEXT):
+                self.finished.add(method.chat_id)
+            return types.Message(
+                message_id=message_id,
+                date=datetime.now(),
+                chat=types.Chat(id=method.chat_id, type='private'),
+                text=method.text,
+            )
+        if isinstance(method, (EditMessageReplyMarkup, DeleteMessage, AnswerCallbackQuery)):
+            return True
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+_update_ids = itertools.count(1)
+# Начало сообщения с итогом квиза (handlers._reply_and_continue)
+FINISHED_TEXT = "Это был последний вопрос!"
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+
+def command_event(user_id: int, text: str = "/quiz") -> dict:
+    update = {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": next(_update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": _user(user_id),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+        },
+    }
+    return {"httpMethod": "POST", "body": json.dumps(update)}
+
+
+def callback_event(user_id: int, message_id: int, data: str) -> dict:
+    update = {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "question",
+            },
+        },
+    }
+    return {"httpMethod": "POST", "body": json.dumps(update)}
+
+
+class Benchmark:
+    def __init__(self, telegram: FakeTelegramSession, db: FakeYdb):
+        self.telegram = telegram
+        self.db = db
+        self.latencies: list[float] = []
+        self.errors = 0
+        self.sessions = 0
+        self.unfinished = 0
+
+    async def send(self, event: dict) -> None:
+        started = time.perf_counter()
+        response = await tb_webhook.webhook(event, None)
+        self.latencies.append(time.perf_counter() - started)
+        if response.get('statusCode') != 200:
+            self.errors += 1
+
+    async def play_session(self, user_id: int) -> None:
+        # /quiz, затем ответ случайной кнопкой на каждый присланный вопрос.
+        # Сессия засчитывается, только если бот прислал итог квиза: ответ 200 на ошибку в хэндлере ничего не значит
+        self.sessions += 1
+        self.telegram.finished.discard(user_id)
+        await self.send(command_event(user_id))
+        for _ in range(bank.quiz_length()):
+            keyboard = self.telegram.keyboards.pop(user_id, None)
+            if keyboard is None:
+                break
+            message_id, markup = keyboard
+            button = random.choice(markup.inline_keyboard)[0]
+            await self.send(callback_event(user_id, message_id, button.callback_data))
+        if user_id not in self.telegram.finished:
+            self.unfinished += 1
+
+    def report(self, elapsed: float) -> dict:
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+
+        def percentile(q: float) -> float:
+            return latencies[min(count - 1, int(q * count))] * 1000 if count else 0.0
+
+        return {
+            'updates': count,
+            'errors': self.errors,
+            'sessions': self.sessions,
+            'unfinished_sessions': self.unfinished,
+            'elapsed_s': round(elapsed, 3),
+            'updates_per_s': round(count / elapsed, 1) if elapsed else 0.0,
+            'p50_ms': round(percentile(0.50), 2),
+            'p95_ms': round(percentile(0.95), 2),
+            'p99_ms': round(percentile(0.99), 2),
+            'db_executes_per_update': round(self.db.executes / count, 2) if count else 0.0,
+            'db_prepares_per_update': round(self.db.prepares / count, 2) if count else 0.0,
+            'telegram_calls_per_update': round(self.telegram.calls / count, 2) if count else 0.0,
+            'query_cache': database.query_cache.stats(),
+            'write_batches': store.batch_stats() if hasattr(store, 'batch_stats') else None,
+            'outbound': sender.stats(),
+        }
+
+
+def callback_checks() -> list[str]:
+    """
+    Checks the signed answer buttons: pack/unpack round trip, prefix separation and signature validation.
+    Returns the names of failed checks.
+    """
+    failed = []
+
+    def check(name: str, passed) -> None:
+        if not passed:
+            failed.append(name)
+
+    for callback in (AnswerCallback, GroupAnswerCallback):
+        data = callback.signed(session=2**63 - 1, position=3, question=42, option=1)
+        unpacked = callback.unpack(data.pack())
+        check(f"{callback.__prefix__}: round trip", unpacked == data and unpacked.is_valid())
+        check(f"{callback.__prefix__}: tampered option rejected", not unpacked.model_copy(update={'option': 2}).is_valid())
+
+    private = AnswerCallback.signed(session=7, position=0, question=5, option=2).pack()
+    group = GroupAnswerCallback.signed(session=7, position=0, question=5, option=2).pack()
+    try:
+        GroupAnswerCallback.unpack(private)
+        check("g: private prefix rejected", False)
+    except ValueError:
+        pass
+    # Подпись покрывает префикс: кнопка с подмененным префиксом разбирается, но не проходит проверку
+    check("a: -> g: forged signature rejected", not GroupAnswerCallback.unpack("g" + private[1:]).is_valid())
+    check("g: -> a: forged signature rejected", not AnswerCallback.unpack("a" + group[1:]).is_valid())
+    return failed
+
+
+def load_events(path: str) -> list[dict]:
+    # Формат requests.jsonl: одно событие облачной функции на строку
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def run(args) -> dict:
+    telegram = FakeTelegramSession(args.tg_latency / 1000)
+    telegram.middleware(sender)
+    telegram.middleware(TelegramTimingMiddleware())
+    tb_webhook.bot.session = telegram
+    db = FakeYdb(args.db_latency / 1000)
+    database.connection.pool = FakeSessionPool(db)
+
+    bench = Benchmark(telegram, db)
+    started = time.perf_counter()
+    if args.events:
+        for event in load_events(args.events):
+            await bench.send(event)
+    if args.users:
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def limited(user_id: int):
+            async with semaphore:
+                await bench.play_session(user_id)
+
+        await asyncio.gather(*(limited(100000 + i) for i in range(args.users)))
+    return bench.report(time.perf_counter() - started)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline quiz bot benchmark")
+    parser.add_argument('--events', help="requests.jsonl-style file with webhook events to replay")
+    parser.add_argument('--users', type=int, default=100, help="synthetic users playing a full quiz")
+    parser.add_argument('--concurrency', type=int, default=50, help="users playing at the same time")
+    parser.add_argument('--db-latency', type=float, default=2.0, help="injected YDB latency per call, ms")
+    parser.add_argument('--tg-latency', type=float, default=20.0, help="injected Telegram API latency per call, ms")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    report['callback_check_failures'] = callback_checks()
+    if args.json:
+        print(json.dumps({'report': report, 'stages': metrics.snapshot()}, ensure_ascii=False, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:>28}: {value}")
+    sys.exit(1 if report['errors'] or report['unfinished_sessions'] or report['callback_check_failures'] else 0)
+
+
+if __name__ == '__main__':
+    main()
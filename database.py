@@ -1,7 +1,15 @@
 import os
 import ydb
+import ydb.aio
 import asyncio
 import logging 
+import re
+import time
+from functools import lru_cache
+from collections import OrderedDict
+from typing import Any, Callable
+from metrics import metrics
+from resilience import call_with_retries
 
 # Заводим логгер для database
 logger = logging.getLogger(__name__)
@@ -9,28 +17,89 @@ logger = logging.getLogger(__name__)
 
 YDB_ENDPOINT = os.getenv("YDB_ENDPOINT")
 YDB_DATABASE = os.getenv("YDB_DATABASE")
+YDB_POOL_SIZE = int(os.getenv("YDB_POOL_SIZE", "100"))
+YDB_CONNECT_TIMEOUT = float(os.getenv("YDB_CONNECT_TIMEOUT", "5"))
+# Пакетная запись: сколько миллисекунд копить строки и сколько строк максимум в одной пачке
+WRITE_BATCH_DELAY_MS = float(os.getenv("WRITE_BATCH_DELAY_MS", "5"))
+WRITE_BATCH_MAX_ROWS = int(os.getenv("WRITE_BATCH_MAX_ROWS", "100"))
+
+# SDK делает одну попытку: повторы, дедлайны и автомат отключения - в resilience.call_with_retries
+retry_settings = ydb.RetrySettings(max_retries=0)
+
+class YdbConnection:
+    """
+    Lazily connected ydb.aio driver and session pool.
+    Подключение стартует в фоне при первом обращении и переиспользуется между теплыми вызовами функции.
+    """
+
+    def __init__(self):
+        self.driver: ydb.aio.Driver | None = None
+        self.pool: ydb.aio.SessionPool | None = None
+        self.connect_time: float | None = None  # секунды, затраченные на подключение
+        self._connect_task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """Starts connecting in the background without waiting for it."""
+        if self.pool is not None:
+            return
+        if self._connect_task is None or self._connect_task.done():
+            self._connect_task = asyncio.get_running_loop().create_task(self._connect())
+
+    async def get_pool(self) -> ydb.aio.SessionPool | None:
+        """
+        Returns the session pool, waiting for the connection if it is still in progress.
+        Returns None if the driver could not connect; the next call will try again.
+        """
+        if self.pool is not None:
+            return self.pool
+        self.start()
+        # shield: отмена одного хэндлера не должна отменять общее подключение
+        return await asyncio.shield(self._connect_task)
+
+    async def _connect(self) -> ydb.aio.SessionPool | None:
+        started = time.perf_counter()
+        driver = ydb.aio.Driver(
+            ydb.DriverConfig(
+                YDB_ENDPOINT,
+                YDB_DATABASE,
+                credentials=ydb.credentials_from_env_variables(),
+                root_certificates=ydb.load_ydb_root_certificate(),
+            )
+        )
+        # Ожидаем готовность драйвера
+        try:
+            await driver.wait(fail_fast=True, timeout=YDB_CONNECT_TIMEOUT)
+        except Exception as e:
+            logger.critical(f"Failed to connect to YDB driver: {e}")
+            await driver.stop()
+            return None
+        self.driver = driver
+        self.pool = ydb.aio.SessionPool(driver, size=YDB_POOL_SIZE)
+        self.connect_time = time.perf_counter() - started
+        logger.info(f"YDB driver is ready, SessionPool initialized (size={YDB_POOL_SIZE}) in {self.connect_time * 1000:.1f} ms.")
+        return self.pool
+
+
+    async def close(self) -> None:
+        """Stops the session pool and the driver (graceful shutdown of a long-lived worker)."""
+        if self._connect_task is not None and not self._connect_task.done():
+            await asyncio.shield(self._connect_task)
+        if self.pool is not None:
+            await self.pool.stop()
+            self.pool = None
+        if self.driver is not None:
+            await self.driver.stop()
+            self.driver = None
+        logger.info("YDB connection closed.")
+
+
+# Глобальное подключение, общее для всех вызовов в рамках одного инстанса
+connection = YdbConnection()
+
+
+async def get_pool() -> ydb.aio.SessionPool | None:
+    return await connection.get_pool()
 
-# Драйвер и глобальный пул
-# Инициализация происходит синхронно при импорте модуля
-driver = ydb.Driver(
-    ydb.DriverConfig(
-        YDB_ENDPOINT,
-        YDB_DATABASE,
-        credentials=ydb.credentials_from_env_variables(),
-        root_certificates=ydb.load_ydb_root_certificate(),
-    )
-)
-# Ожидаем готовность драйвера
-try:
-    driver.wait(fail_fast=True, timeout=5)
-    logger.info("YDB driver is ready.")
-except Exception as e:
-    logger.critical(f"Failed to connect to YDB driver: {e}")
-
-
-# Глобальный пул
-pool: ydb.SessionPool = ydb.SessionPool(driver)
-logger.info("YDB SessionPool initialized.")
 
 # Вопросы и ответы
 quiz_data = [
@@ -86,48 +155,158 @@ quiz_data = [
     }
 ]
 
+class PreparedQueryCache:
+    """
+    Bounded LRU of prepared statements keyed by (session_id, query text).
+    Запрос компилируется один раз на сессию пула, дальше берется из кэша.
+    """
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Все обращения идут из одного event loop, отдельная блокировка не нужна
+        self._items: OrderedDict = OrderedDict()
+        # Запросы, которые сейчас компилируются: одновременные промахи по ключу ждут один prepare
+        self._in_flight: dict[tuple, asyncio.Future] = {}
+
+    async def prepare(self, session: ydb.aio.table.Session, query: str):
+        key = (session.session_id, query)
+        prepared = self._items.get(key)
+        if prepared is not None:
+            self._items.move_to_end(key)
+            self.hits += 1
+            return prepared
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.hits += 1
+            # shield: отмена одного ждущего не отменяет prepare для остальных
+            return await asyncio.shield(in_flight)
+        self.misses += 1
+
+        in_flight = self._in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            prepared = await session.prepare(query)
+        except BaseException as e:
+            # Ждущие получают ту же ошибку, их retry повторит запрос
+            if isinstance(e, asyncio.CancelledError):
+                in_flight.cancel()
+            else:
+                in_flight.set_exception(e)
+                in_flight.exception()  # ждущих может не быть, ошибка уже проброшена здесь
+            raise
+        finally:
+            del self._in_flight[key]
+        self._items[key] = prepared
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        in_flight.set_result(prepared)
+        return prepared
+
+    def discard(self, session: ydb.aio.table.Session, query: str) -> None:
+        # Вызывается при ошибке выполнения: сессия могла умереть или сервер забыл запрос
+        self._items.pop((session.session_id, query), None)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items), 'max_size': self.max_size}
+
+
+# Ключ кэша - (сессия, запрос), поэтому рабочий набор - размер пула на число разных запросов бота (около 20).
+# По умолчанию кэш вмещает его целиком с запасом, иначе LRU вытесняет запросы и почти каждый вызов платит за prepare
+YDB_STATEMENTS_PER_SESSION = int(os.getenv("YDB_STATEMENTS_PER_SESSION", "32"))
+query_cache = PreparedQueryCache(int(os.getenv("YDB_QUERY_CACHE_SIZE", str(YDB_POOL_SIZE * YDB_STATEMENTS_PER_SESSION))))
+
+
+async def prepare(session: ydb.aio.table.Session, query: str):
+    return await query_cache.prepare(session, query)
+
+
 # Оставляем простую версию, добавляющую $ к ключам
 def _format_kwargs(kwargs):
     return {
         '$' + k: v for k, v in kwargs.items()
     }
 
-async def execute_update_query(pool: ydb.SessionPool, query: str, **kwargs) -> None:
-    def callee(session: ydb.Session):
-        prepared_query = session.prepare(query)
+@lru_cache(maxsize=256)
+def _statement_name(query: str) -> str:
+    # Имя по умолчанию для метрик: первая операция и таблица, например "upsert quiz_state"
+    operation = re.search(r'\b(SELECT|UPSERT|UPDATE|INSERT|REPLACE|DELETE)\b', query, re.I)
+    if operation is None:
+        return "query"
+    rest = query[operation.start():]
+    table = re.search(r'`(\w+)`', rest) or re.search(r'\b(?:FROM|INTO|UPDATE)\s+(\w+)', rest, re.I)
+    return f"{operation.group(1).lower()} {table.group(1)}" if table else operation.group(1).lower()
+
+
+async def _retry(pool: ydb.aio.SessionPool, callee, name: str):
+    # Одна попытка SDK на каждый повтор resilience: дедлайн и бюджет повторов общие для всего вызова
+    return await call_with_retries(lambda: pool.retry_operation(callee, retry_settings=retry_settings), name)
+
+
+async def execute_update_query(pool: ydb.aio.SessionPool, query: str, query_name: str | None = None, **kwargs) -> None:
+    async def callee(session: ydb.aio.table.Session):
+        prepared_query = await prepare(session, query)
         tx_context = session.transaction(ydb.SerializableReadWrite())
         try:
-            result_sets = tx_context.execute(prepared_query, _format_kwargs(kwargs), commit_tx=True)
+            result_sets = await tx_context.execute(prepared_query, _format_kwargs(kwargs), commit_tx=True)
             return result_sets
         except Exception as e:
-            tx_context.rollback()
+            query_cache.discard(session, query)
+            await tx_context.rollback()
             logger.error(f"Update query failed: {query} with params {kwargs}", exc_info=True)
             raise
-    await asyncio.get_event_loop().run_in_executor(
-        None, lambda: pool.retry_operation_sync(callee)
-    )
+    with metrics.timer('ydb', query_name or _statement_name(query)):
+        await _retry(pool, callee, query_name or _statement_name(query))
+
+async def execute_transaction(pool: ydb.aio.SessionPool, callee, query_name: str | None = None):
+    """
+    Runs the async callee(session) with retries; callee manages its own transaction.
+    Используется, когда чтение и запись должны попасть в одну транзакцию.
+    """
+    name = query_name or callee.__qualname__
+    with metrics.timer('ydb', name):
+        return await _retry(pool, callee, name)
+
+async def execute_select_records(pool: ydb.aio.SessionPool, query: str, record: Callable[[Any], Any], query_name: str | None = None, **kwargs) -> list:
+    """
+    Runs a read-only query and maps each row of the first result set with record(row).
+    В отличие от execute_select_query строки не копируются в промежуточные словари.
+    """
+    async def callee(session: ydb.aio.table.Session):
+        tx_context = session.transaction(ydb.OnlineReadOnly())
+        try:
+            result_sets = await tx_context.execute(await prepare(session, query), _format_kwargs(kwargs), commit_tx=True)
+            return [record(row) for row in result_sets[0].rows] if result_sets else []
+        except Exception:
+            query_cache.discard(session, query)
+            await tx_context.rollback()
+            logger.error(f"Select query {query_name or _statement_name(query)} failed with params {kwargs}", exc_info=True)
+            raise
+
+    with metrics.timer('ydb', query_name or _statement_name(query)):
+        return await _retry(pool, callee, query_name or _statement_name(query))
 
-async def execute_select_query(pool: ydb.SessionPool, query: str, **kwargs) -> list[dict]:
-    def callee(session: ydb.Session):
-        prepared_query = session.prepare(query)
+async def execute_select_query(pool: ydb.aio.SessionPool, query: str, query_name: str | None = None, **kwargs) -> list[dict]:
+    async def callee(session: ydb.aio.table.Session):
+        prepared_query = await prepare(session, query)
         # Используем OnlineReadOnly для SELECT запросов
         tx_context = session.transaction(ydb.OnlineReadOnly())
         try:
-            result_sets = tx_context.execute(prepared_query, _format_kwargs(kwargs), commit_tx=True) 
+            result_sets = await tx_context.execute(prepared_query, _format_kwargs(kwargs), commit_tx=True) 
             if not result_sets:
                  logger.warning(f"Select query returned no result sets: {query} with params {kwargs}")
                  return [] # Вернуть пустой список строк, если нет наборов результатов
             # Возвращаем строки из первого набора результатов
             return result_sets[0].rows
         except Exception as e:
+            query_cache.discard(session, query)
             # Для Readonly транзакций откат не всегда необходим, но хорошая практика
-            tx_context.rollback()
+            await tx_context.rollback()
             logger.error(f"Select query failed: {query} with params {kwargs}", exc_info=True)
             raise
 
-    results_from_callee = await asyncio.get_event_loop().run_in_executor(
-        None, lambda: pool.retry_operation_sync(callee)
-    )
+    with metrics.timer('ydb', query_name or _statement_name(query)):
+        results_from_callee = await _retry(pool, callee, query_name or _statement_name(query))
 
     if not isinstance(results_from_callee, list):
         logger.error(f"Unexpected non-list result from YDB select: {results_from_callee}")
@@ -152,3 +331,94 @@ async def execute_select_query(pool: ydb.SessionPool, query: str, **kwargs) -> l
              return [] 
 
     return final_results
+
+
+class WriteBatcher:
+    """
+    Coalesces single-row writes from many users into one bulk statement over AS_TABLE($rows).
+    Каждый вызывающий ждет свой future, который завершается только после коммита пачки с его строкой,
+    поэтому гарантии записи для отдельного пользователя не ослабевают.
+
+    The statement takes a single $rows parameter. If it returns a result set, it lists the keys
+    (column named like the key) of rows it rejected, e.g. on version conflicts: their callers get False.
+    """
+
+    def __init__(self, query: str, key: str, query_name: str,
+                 max_rows: int = WRITE_BATCH_MAX_ROWS, delay: float = WRITE_BATCH_DELAY_MS / 1000):
+        self.query = query
+        self.key = key
+        self.query_name = query_name
+        self.max_rows = max(1, max_rows)
+        self.delay = delay
+        self.batches = 0
+        self.rows = 0
+        self.writes = 0
+        # key -> (последняя строка для ключа, futures всех ее писателей)
+        self._pending: dict[Any, tuple[dict, list[asyncio.Future]]] = {}
+        self._full = asyncio.Event()
+        self._flush_task: asyncio.Task | None = None
+
+    async def write(self, row: dict) -> bool:
+        """Queues the row and waits until its batch is committed; returns False if the statement rejected it."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = row[self.key]
+        pending = self._pending.get(key)
+        # Несколько записей одного ключа в пачке схлопываются в последнюю
+        self._pending[key] = (row, pending[1] + [future] if pending else [future])
+        self.writes += 1
+        if len(self._pending) >= self.max_rows:
+            self._full.set()
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush_loop())
+        return await future
+
+    async def _flush_loop(self) -> None:
+        # Пачки пишутся строго по одной: пока идет запись, следующая пачка копится
+        while self._pending:
+            if len(self._pending) < self.max_rows and self.delay > 0:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.delay)
+                except asyncio.TimeoutError:
+                    pass
+            keys = list(self._pending)[:self.max_rows]
+            batch = {key: self._pending.pop(key) for key in keys}
+            await self._flush(batch)
+
+    async def _flush(self, batch: dict[Any, tuple[dict, list[asyncio.Future]]]) -> None:
+        rows = [row for row, _ in batch.values()]
+        try:
+            pool = await get_pool()
+            if pool is None:
+                raise ConnectionError("YDB pool is unavailable")
+            rejected = await self._execute(pool, rows)
+        except Exception as e:
+            logger.error(f"Batched write {self.query_name} of {len(rows)} rows failed: {e}")
+            for _, futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        self.batches += 1
+        self.rows += len(rows)
+        for key, (_, futures) in batch.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(key not in rejected)
+
+    async def _execute(self, pool: ydb.aio.SessionPool, rows: list[dict]) -> set:
+        async def callee(session: ydb.aio.table.Session):
+            tx_context = session.transaction(ydb.SerializableReadWrite())
+            try:
+                result_sets = await tx_context.execute(await prepare(session, self.query), {'$rows': rows}, commit_tx=True)
+                return {row[self.key] for row in result_sets[0].rows} if result_sets else set()
+            except Exception:
+                query_cache.discard(session, self.query)
+                await tx_context.rollback()
+                raise
+
+        return await execute_transaction(pool, callee, query_name=self.query_name)
+
+    def stats(self) -> dict:
+        return {'writes': self.writes, 'rows': self.rows, 'batches': self.batches, 'pending': len(self._pending)}
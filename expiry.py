@@ -0,0 +1,116 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+# Сколько истекших вопросов обрабатывается одновременно
+EXPIRY_CONCURRENCY = int(os.getenv("EXPIRY_CONCURRENCY", "32"))
+# Сколько истекших состояний читать из хранилища за один запрос обхода
+EXPIRY_SWEEP_BATCH = int(os.getenv("EXPIRY_SWEEP_BATCH", "500"))
+EXPIRY_SWEEP_MAX_BATCHES = int(os.getenv("EXPIRY_SWEEP_MAX_BATCHES", "20"))
+
+# handler(user_id, session_id, question_index) - обработка вопроса, на который не ответили вовремя
+ExpiryHandler = Callable[[int, int, int], Awaitable[None]]
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+class ExpiryScheduler:
+    """
+    One timer for all timed questions of the process: a heap of deadlines and a single task
+    that sleeps until the earliest one. Per-user asyncio tasks are not created.
+
+    At most one deadline per key (user, or chat for group rounds) is active.
+    Rescheduling or cancelling leaves the old heap entry in place; it is skipped when it comes up.
+    """
+
+    def __init__(self, concurrency: int = EXPIRY_CONCURRENCY):
+        self.handler: ExpiryHandler | None = None
+        self.fired = 0
+        self._heap: list[tuple[int, int, int, int]] = []  # (срок в мс, user_id, session_id, question_index)
+        self._active: dict[int, tuple[int, int, int]] = {}  # user_id -> (срок, session_id, question_index)
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._running: set[asyncio.Task] = set()
+
+    def schedule(self, user_id: int, session_id: int, question_index: int, deadline_ms: int) -> None:
+        self._active[user_id] = (deadline_ms, session_id, question_index)
+        heapq.heappush(self._heap, (deadline_ms, user_id, session_id, question_index))
+        if self._heap[0][0] == deadline_ms:
+            # Новый срок раньше всех: таймер надо перевести
+            self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def cancel(self, user_id: int) -> None:
+        self._active.pop(user_id, None)
+
+    async def _run(self) -> None:
+        while self._heap:
+            self._wakeup.clear()
+            deadline, user_id, session_id, question_index = self._heap[0]
+            delay = (deadline - now_ms()) / 1000
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            if self._active.get(user_id) != (deadline, session_id, question_index):
+                continue  # срок отменен или перенесен
+            del self._active[user_id]
+            self._fire(user_id, session_id, question_index)
+
+    def _fire(self, user_id: int, session_id: int, question_index: int) -> None:
+        if self.handler is None:
+            logger.warning(f"User {user_id}: Question {question_index} expired, but no expiry handler is set.")
+            return
+        self.fired += 1
+        task = asyncio.get_running_loop().create_task(self._handle(user_id, session_id, question_index))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _handle(self, user_id: int, session_id: int, question_index: int) -> None:
+        async with self._semaphore:
+            try:
+                await self.handler(user_id, session_id, question_index)
+            except Exception:
+                logger.error(f"User {user_id}: Failed to expire question {question_index}.", exc_info=True)
+
+    def stats(self) -> dict:
+        return {'active': len(self._active), 'heap': len(self._heap), 'fired': self.fired}
+
+
+scheduler = ExpiryScheduler()
+
+
+async def sweep(store, grace_ms: int = 0) -> int:
+    """
+    Expires every timed question whose deadline has passed according to the store.
+    Для облачной функции, которая между вызовами не работает: вызывается по таймер-триггеру и при старте воркера.
+    Returns the number of expired questions handled.
+    """
+    if scheduler.handler is None:
+        return 0
+    handled = 0
+    for _ in range(EXPIRY_SWEEP_MAX_BATCHES):
+        states = await store.expired(now_ms() - grace_ms, EXPIRY_SWEEP_BATCH)
+        for user_id in states:
+            scheduler.cancel(user_id)
+        await asyncio.gather(*(
+            scheduler._handle(user_id, state.session_id, state.question_index) for user_id, state in states.items()
+        ))
+        handled += len(states)
+        if len(states) < EXPIRY_SWEEP_BATCH:
+            break
+    if handled:
+        logger.info(f"Expiry sweep handled {handled} timed out questions.")
+    return handled
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from aiogram import Bot, types, F, Router
+from aiogram.filters import Command, ExceptionTypeFilter
+import multiplayer
+import results
+from handlers import STALE_ANSWER_TEXT, handle_storage_unavailable
+from question_bank import bank, ensure_loaded
+from question_catalog import GroupAnswerCallback, payload_at
+from resilience import StorageUnavailableError
+
+# Групповой квиз: один вопрос на весь чат, ответы участников копятся в памяти до конца раунда
+logger = logging.getLogger(__name__)
+
+router = Router()
+# Подключается к диспетчеру раньше handlers.router, поэтому ответы из групп не доходят до личного квиза
+router.message.filter(F.chat.type.in_({"group", "supergroup"}))
+router.callback_query.filter(F.message.chat.type.in_({"group", "supergroup"}))
+router.errors.register(handle_storage_unavailable, ExceptionTypeFilter(StorageUnavailableError))
+
+# Сколько имен верно ответивших перечислять в итоге раунда: сообщение Telegram ограничено 4096 символами
+WINNERS_SHOWN = 20
+
+
+async def send_round_question(bot: Bot, chat_id: int, session_id: int, question_index: int):
+    payload = payload_at(session_id, question_index, GroupAnswerCallback)
+    text = f"Вопрос {question_index + 1} из {bank.quiz_length()}\n\n{payload.text}\n\n⏱ На ответ {multiplayer.GROUP_ROUND_SECONDS} с."
+    sent_message = await bot.send_message(chat_id, text, reply_markup=payload.reply_markup)
+    multiplayer.open_round(chat_id, session_id, question_index, sent_message.message_id)
+
+
+# Обработчик команды /group: новый квиз для всего чата
+@router.message(Command("group"))
+async def cmd_group(message: types.Message):
+    chat_id = message.chat.id
+    logger.info(f"Chat {chat_id}: Received /group from user {message.from_user.id}.")
+    await ensure_loaded()
+    if bank.quiz_length() == 0:
+        logger.critical(f"Chat {chat_id}: Question bank is empty.")
+        await message.answer("Критическая ошибка при подготовке квиза :( Обратитесь к администратору.")
+        return
+    session_id = multiplayer.new_session_id()
+    await message.answer(f"Групповой квиз! Отвечать может каждый, на вопрос {multiplayer.GROUP_ROUND_SECONDS} с.")
+    await send_round_question(message.bot, chat_id, session_id, 0)
+
+
+# Ответ участника только записывается в раунд: ни чтения, ни записи в хранилище на нажатие
+@router.callback_query(GroupAnswerCallback.filter())
+async def handle_group_answer(callback: types.CallbackQuery, callback_data: GroupAnswerCallback):
+    user_id: int = callback.from_user.id
+    if not callback_data.is_valid():
+        logger.warning(f"User {user_id}: Group answer callback with invalid signature {callback.data!r}.")
+        await callback.answer()
+        return
+    accepted = multiplayer.record_answer(
+        callback.message.chat.id, callback_data.session, callback_data.position,
+        user_id, callback.from_user.full_name, callback_data.option,
+    )
+    if accepted is None:
+        await callback.answer(STALE_ANSWER_TEXT)
+    elif not accepted:
+        await callback.answer("Вы уже ответили на этот вопрос.")
+    else:
+        await callback.answer("Ответ принят!")
+
+
+def _format_standings(scores: list[multiplayer.PlayerScore]) -> str:
+    if not scores:
+        return "Никто не набрал очков."
+    return "\n".join(f"{place}. {item.name or item.user_id}: {item.score}" for place, item in enumerate(scores, start=1))
+
+
+# Срок раунда истек: вызывается multiplayer.round_scheduler
+async def close_group_round(bot: Bot, chat_id: int, session_id: int, question_index: int):
+    round_ = multiplayer.take_round(chat_id, session_id, question_index)
+    if round_ is None:
+        return  # раунд уже закрыт или в чате начат новый квиз
+    saved = True
+    try:
+        await multiplayer.save_round(round_)
+    except Exception:
+        logger.error(f"Chat {chat_id}: Failed to save round {question_index} scores.", exc_info=True)
+        saved = False
+
+    question = bank.question_at(session_id, question_index)
+    answers = list(round_.answers.values())
+    await results.record_answers(question.id, [correct for _, correct in answers])
+    winners = [name for name, correct in answers if correct]
+    summary = f"Время вышло! Правильный ответ: {question.correct_option_text}"
+    if winners:
+        summary += f"\nВерно ответили ({len(winners)}): {', '.join(winners[:WINNERS_SHOWN])}"
+        if len(winners) > WINNERS_SHOWN:
+            summary += f" и ещё {len(winners) - WINNERS_SHOWN}"
+    else:
+        summary += "\nВерных ответов нет."
+    if not saved:
+        summary += "\nОчки этого раунда не удалось сохранить :("
+
+    async def remove_keyboard():
+        try:
+            await bot.edit_message_reply_markup(chat_id=chat_id, message_id=round_.message_id, reply_markup=None)
+        except Exception as e:
+            logger.warning(f"Chat {chat_id}: Failed to edit message reply markup {round_.message_id}: {e}")
+
+    async def announce_and_continue():
+        # Итог раунда не обязателен: если он не ушел, игра все равно продолжается
+        try:
+            await bot.send_message(chat_id, summary)
+        except Exception as e:
+            logger.warning(f"Chat {chat_id}: Failed to send round {question_index} summary: {e}")
+        if question_index + 1 < bank.quiz_length():
+            await send_round_question(bot, chat_id, session_id, question_index + 1)
+        else:
+            scores = await multiplayer.standings(chat_id, session_id)
+            await bot.send_message(chat_id, f"Квиз окончен! Итоги:\n{_format_standings(scores)}")
+
+    await asyncio.gather(remove_keyboard(), announce_and_continue())
@@ -1,31 +1,38 @@
+import asyncio
 import logging
-from aiogram import types, F, Router
-from aiogram.filters import Command, CommandStart
-from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
-from database import quiz_data, pool
+from aiogram import Bot, types, F, Router
+from aiogram.filters import Command, CommandStart, ExceptionTypeFilter
+from aiogram.utils.keyboard import ReplyKeyboardBuilder
+from question_bank import bank, ensure_loaded, Question
+from question_catalog import AnswerCallback
+import results
+from resilience import StorageUnavailableError, breaker
+from state_store import QuizStateStore, get_store
 from service import (
-    get_quiz_index,
-    update_quiz_index,
-    get_user_score,
-    update_user_score,
     reset_user_quiz_state,
-    generate_options_keyboard,
     get_question,
-    update_last_question_message_id, 
+    send_question_to,
+    advance_quiz,
+    QuizProgress,
+    QUIZ_TIME_LIMIT,
+    StaleAnswerError,
+    is_stale_answer,
     get_last_question_message_id 
 )
-import ydb
 
 
 logger = logging.getLogger(__name__)
 
 router = Router()
 
-# Функция для удаления предыдущего сообщения
-async def delete_previous_message(message: types.Message, pool: ydb.SessionPool):
+STALE_ANSWER_TEXT = "Этот вопрос уже неактуален."
+TRY_LATER_TEXT = "Сервис временно перегружен, попробуйте через минуту."
+
+# Функция для удаления предыдущего сообщения.
+# message_id в БД обнуляет идущий параллельно reset_user_quiz_state
+async def delete_previous_message(message: types.Message, last_message_id: int | None):
     user_id = message.from_user.id
     chat_id = message.chat.id
-    last_message_id = await get_last_question_message_id(pool, user_id)
     if last_message_id:
         try:
             # Пытаемся удалить сообщение бота
@@ -34,8 +41,23 @@ async def delete_previous_message(message: types.Message, pool: ydb.SessionPool)
         except Exception as e:
             # Логируем ошибку, если не удалось удалить 
             logger.warning(f"User {user_id}: Failed to delete previous message {last_message_id} in chat {chat_id}: {e}")
-    # Обнуляем message_id в БД после попытки удаления, даже если удаление не удалось
-    await update_last_question_message_id(pool, user_id, 0)
+
+
+# message.answer() возвращает объект метода SendMessage, а не корутину: в asyncio.gather его не передать
+async def _send(message: types.Message, text: str) -> types.Message:
+    return await message.answer(text)
+
+
+# Удаление старого сообщения в Telegram и сброс состояния в хранилище не зависят друг от друга
+async def restart_quiz_state(message: types.Message, store: QuizStateStore, *extra, time_limit: int = 0):
+    user_id = message.from_user.id
+    # message_id читаем до сброса, иначе сброс его обнулит
+    last_message_id = await get_last_question_message_id(store, user_id)
+    await asyncio.gather(
+        delete_previous_message(message, last_message_id),
+        reset_user_quiz_state(store, user_id, time_limit),
+        *extra,
+    )
 
 
 # Обработчик команды /start
@@ -43,14 +65,13 @@ async def delete_previous_message(message: types.Message, pool: ydb.SessionPool)
 async def cmd_start(message: types.Message):
     user_id: int = message.from_user.id
     logger.info(f"User {user_id}: Received /start command.")
-    if pool is None:
-        logger.critical(f"User {user_id}: Global YDB pool is None!")
+    store = await get_store()
+    if store is None:
+        logger.critical(f"User {user_id}: Quiz state store is unavailable!")
         await message.answer("Произошла критическая ошибка с подключением к базе данных :( Попробуйте позже.")
         return
     # Удаляем предыдущее сообщение перед началом нового квиза
-    await delete_previous_message(message, pool)
-
-    await reset_user_quiz_state(pool, user_id)
+    await restart_quiz_state(message, store)
     builder = ReplyKeyboardBuilder()
     builder.add(types.KeyboardButton(text="Начать квиз"))
     await message.answer("Бобро поржаловать! Наржите 'Начать квиз' для старжа.", reply_markup=builder.as_markup(resize_keyboard=True))
@@ -60,82 +81,93 @@ async def cmd_start(message: types.Message):
 @router.message(F.text == "Начать квиз")
 @router.message(Command("quiz"))
 async def cmd_quiz(message: types.Message):
+    logger.info(f"User {message.from_user.id}: Received /quiz or 'Начать квиз'.")
+    await _start_quiz(message, "Да начнётся игра!")
+
+
+# Обработчик команды /timed: квиз, где на каждый вопрос дается QUIZ_TIME_LIMIT секунд.
+# Только в личном чате: истекший вопрос закрывается без апдейта, и ответ уходит в чат с id пользователя
+@router.message(Command("timed"))
+async def cmd_timed(message: types.Message):
+    logger.info(f"User {message.from_user.id}: Received /timed.")
+    if message.chat.type != "private":
+        await message.answer("Квиз на время доступен только в личном чате с ботом.")
+        return
+    await _start_quiz(message, f"Квиз на время: на каждый вопрос {QUIZ_TIME_LIMIT} с!", time_limit=QUIZ_TIME_LIMIT)
+
+
+async def _start_quiz(message: types.Message, greeting: str, time_limit: int = 0):
     user_id: int = message.from_user.id
-    logger.info(f"User {user_id}: Received /quiz or 'Начать квиз'.")
-    if pool is None:
-        logger.critical(f"User {user_id}: Global YDB pool is None!")
+    store = await get_store()
+    if store is None:
+        logger.critical(f"User {user_id}: Quiz state store is unavailable!")
         await message.answer("Произошла критическая ошибка с подключением к базе данных :( Попробуйте позже.")
         return
+    await ensure_loaded()
     # Удаляем предыдущее сообщение перед началом нового квиза
-    await delete_previous_message(message, pool)
-    await reset_user_quiz_state(pool, user_id)
-    await message.answer("Да начнётся игра!")
-    # Передаем pool в get_question (он там нужен как аргумент)
-    await get_question(pool, message, user_id)
+    await restart_quiz_state(message, store, _send(message, greeting), time_limit=time_limit)
+    await get_question(store, message, user_id)
 
 
-# Обработчики для ответов
-@router.callback_query(F.data == "right_answer")
-async def handle_right_answer(callback: types.CallbackQuery):
-    user_id: int = callback.from_user.id
-    logger.debug(f"User {user_id}: Received right answer callback.")
-    if pool is None:
-         logger.critical(f"User {user_id}: Global YDB pool is None!")
-         await callback.message.answer("Произошла критическая ошибка с подключением к базе данных :( Попробуйте позже.")
-         await callback.answer()
-         return
-    # Удаляем клавиатуру предыдущего сообщения (сообщение с вопросом, на который ответили)
-    try:
-        await callback.bot.edit_message_reply_markup(
-            chat_id=callback.message.chat.id,
-            message_id=callback.message.message_id,
-            reply_markup=None
-        )
-    except Exception as e:
-         logger.warning(f"User {user_id}: Failed to edit message reply markup {callback.message.message_id}: {e}")
+def _format_leaderboard(title: str, entries: list[results.LeaderboardEntry], user_id: int) -> str:
+    if not entries:
+        return f"{title}\nПока никто не прошел квиз."
+    lines = [title]
+    for place, entry in enumerate(entries, start=1):
+        marker = " ← вы" if entry.user_id == user_id else ""
+        lines.append(f"{place}. {entry.name or entry.user_id}: {entry.score} из {entry.quiz_length}{marker}")
+    return "\n".join(lines)
 
 
-    current_question_index: int = await get_quiz_index(pool, user_id)
+# /group доходит сюда, только если групповой квиз выключен (облачная функция, см. multiplayer.GROUP_QUIZ_ENABLED)
+@router.message(Command("group"))
+async def cmd_group_unsupported(message: types.Message):
+    logger.info(f"User {message.from_user.id}: Received /group, group quiz is disabled.")
+    await message.answer("Групповой квиз здесь недоступен :( Он работает, только когда бот запущен постоянным процессом.")
 
-    # Проверяем валидность индекса перед доступом к quiz_data
-    if current_question_index is None or current_question_index < 0 or current_question_index >= len(quiz_data):
-         logger.error(f"User {user_id}: Invalid question index {current_question_index} in right answer callback. Resetting state.")
-         await reset_user_quiz_state(pool, user_id)
-         await callback.message.answer("Произошла ошибка состояния квиза :( Попробуйте начать заново.")
-         await callback.answer()
-         return # Важно выйти после обработки ошибки состояния
 
-    current_score: int = await get_user_score(pool, user_id)
-    current_score += 1
-    await update_user_score(pool, user_id, current_score)
-    await callback.message.answer("Верно!")
+# Обработчик команды /top: читает только снимок в памяти, таблица результатов не сканируется
+@router.message(Command("top"))
+async def cmd_top(message: types.Message):
+    user_id: int = message.from_user.id
+    logger.info(f"User {user_id}: Received /top command.")
+    await ensure_loaded()
+    snapshot = await results.get_snapshot()
+    await message.answer("\n\n".join([
+        _format_leaderboard("🏆 Лучшие в этом квизе:", snapshot.top(results.quiz_scope()), user_id),
+        _format_leaderboard("🌍 Лучшие за все время:", snapshot.top(results.GLOBAL_SCOPE), user_id),
+    ]))
 
-    current_question_index += 1
-    await update_quiz_index(pool, user_id, current_question_index)
 
-    if current_question_index < len(quiz_data):
-        await get_question(pool, callback.message, user_id)
-    else:
-        total_score: int = await get_user_score(pool, user_id)
-        await reset_user_quiz_state(pool, user_id)
-        # Обнуляем message_id в БД при завершении квиза
-        await update_last_question_message_id(pool, user_id, 0)
-        await callback.message.answer(f"Это был последний вопрос! Ваш результат: {total_score} правильных ответов из 10.")
-    await callback.answer() # Отвечаем на колбэк
+# Обработчик команды /stats: доля правильных ответов по вопросам, сначала самые сложные
+@router.message(Command("stats"))
+async def cmd_stats(message: types.Message):
+    logger.info(f"User {message.from_user.id}: Received /stats command.")
+    await ensure_loaded()
+    snapshot = await results.get_snapshot()
+    stats = sorted(
+        (item for item in snapshot.question_stats.values() if item.answered and bank.get(item.question_id) is not None),
+        key=lambda item: item.accuracy,
+    )
+    if not stats:
+        await message.answer("Статистики по вопросам пока нет.")
+        return
+    lines = ["📊 Самые сложные вопросы:"]
+    for item in stats[:5]:
+        lines.append(f"{item.accuracy:.0%} ({item.answered} отв.) - {bank.get(item.question_id).text}")
+    await message.answer("\n".join(lines))
 
 
-# Обработчик для неправильных ответов
-@router.callback_query(F.data == "wrong_answer")
-async def handle_wrong_answer(callback: types.CallbackQuery):
-    user_id: int = callback.from_user.id
-    logger.debug(f"User {user_id}: Received wrong answer callback.")
-    if pool is None:
-         logger.critical(f"User {user_id}: Global YDB pool is None!")
-         await callback.message.answer("Произошла критическая ошибка с подключением к базе данных :( Попробуйте позже.")
-         await callback.answer()
-         return
-
-    # Удаляем клавиатуру предыдущего сообщения
+async def _acknowledge(callback: types.CallbackQuery):
+    # Снимаем "часики" с кнопки; ошибка здесь не должна мешать обработке ответа
+    try:
+        await callback.answer()
+    except Exception as e:
+        logger.warning(f"User {callback.from_user.id}: Failed to answer callback query: {e}")
+
+
+async def _remove_answer_keyboard(callback: types.CallbackQuery):
+    # Удаляем клавиатуру сообщения с вопросом, на который ответили
     try:
         await callback.bot.edit_message_reply_markup(
             chat_id=callback.message.chat.id,
@@ -143,34 +175,161 @@ async def handle_wrong_answer(callback: types.CallbackQuery):
             reply_markup=None
         )
     except Exception as e:
-         logger.warning(f"User {user_id}: Failed to edit message reply markup {callback.message.message_id}: {e}")
+         logger.warning(f"User {callback.from_user.id}: Failed to edit message reply markup {callback.message.message_id}: {e}")
+
 
+async def _reply_and_continue(store: QuizStateStore, bot: Bot, chat_id: int, user_id: int, feedback: str, progress: QuizProgress):
+    # Порядок сообщений в чате важен: сначала результат ответа, потом следующий вопрос
+    await bot.send_message(chat_id, feedback)
+    if not progress.finished:
+        await send_question_to(store, bot, chat_id, user_id, progress.question_index, progress.session_id)
+    else:
+        # Состояние и message_id уже обнулены в транзакции advance_quiz
+        await bot.send_message(chat_id, f"Это был последний вопрос! Ваш результат: {progress.score} правильных ответов из {progress.quiz_length}.")
+
+
+# Общая часть обработки ответа: одна транзакция вместо цепочки чтений/записей,
+# независимые вызовы Telegram идут параллельно
+async def process_answer(callback: types.CallbackQuery, answer: AnswerCallback, question: Question):
+    user_id: int = callback.from_user.id
+    # Нажатие позади несброшенного состояния в кэше отсекаем в памяти, до любых сетевых вызовов.
+    # Остальные расхождения с кэшем проверяет advance_quiz по хранилищу
+    if is_stale_answer(user_id, answer.session, answer.position):
+        logger.info(f"User {user_id}: Stale answer for session {answer.session}, position {answer.position}.")
+        await callback.answer(STALE_ANSWER_TEXT)
+        return
+    # Подтверждение нажатия уходит первым и не ждет хранилище
+    ack = asyncio.ensure_future(_acknowledge(callback))
+    try:
+        store = await get_store()
+        if store is None:
+             logger.critical(f"User {user_id}: Quiz state store is unavailable!")
+             await callback.message.answer("Произошла критическая ошибка с подключением к базе данных :( Попробуйте позже.")
+             return
 
-    current_question_index: int = await get_quiz_index(pool, user_id)
+        answered_correctly = answer.option == question.correct_option
+        try:
+            progress = await advance_quiz(store, user_id, answered_correctly, answer.session, answer.position)
+        except StaleAnswerError:
+            # Устаревшее нажатие обнаружено по актуальной строке в хранилище
+            logger.info(f"User {user_id}: Stale answer for session {answer.session}, position {answer.position}.")
+            return
 
-    # Проверяем валидность индекса перед доступом к quiz_data
-    if current_question_index is None or current_question_index < 0 or current_question_index >= len(quiz_data):
-         logger.error(f"User {user_id}: Invalid question index {current_question_index} in wrong answer callback. Resetting state.")
-         await reset_user_quiz_state(pool, user_id)
-         await callback.message.answer("Произошла ошибка состояния квиза :( Попробуйте начать заново.")
-         await callback.answer()
-         return # Важно выйти после обработки ошибки состояния
+        # advance_quiz уже сбросил состояние, если индекс был невалидным
+        if progress is None:
+             logger.error(f"User {user_id}: Invalid question index in answer callback. State has been reset.")
+             await asyncio.gather(
+                 _remove_answer_keyboard(callback),
+                 _send(callback.message, "Произошла ошибка состояния квиза :( Попробуйте начать заново."),
+             )
+             return # Важно выйти после обработки ошибки состояния
 
+        await results.record_answer(question.id, answered_correctly and not progress.timed_out)
 
-    correct_option: int = quiz_data[current_question_index]['correct_option']
-    correct_option_text: str = quiz_data[current_question_index]['options'][correct_option]
+        if progress.timed_out:
+            feedback = f"Время вышло, ответ не засчитан. Правильный ответ: {question.correct_option_text}"
+        elif answered_correctly:
+            feedback = "Верно!"
+        else:
+            feedback = f"Неправильно. Правильный ответ: {question.correct_option_text}"
 
-    await callback.message.answer(f"Неправильно. Правильный ответ: {correct_option_text}")
+        reply = _reply_and_continue(store, callback.bot, callback.message.chat.id, user_id, feedback, progress)
+        if progress.finished:
+            # Результат записывается параллельно с ответами в чат
+            record = results.record_run(user_id, callback.from_user.full_name, progress.session_id, progress.score, progress.quiz_length)
+            await asyncio.gather(_remove_answer_keyboard(callback), reply, record)
+        else:
+            await asyncio.gather(_remove_answer_keyboard(callback), reply)
+    finally:
+        await ack
 
-    current_question_index += 1
-    await update_quiz_index(pool, user_id, current_question_index)
 
-    if current_question_index < len(quiz_data):
-        await get_question(pool, callback.message, user_id)
+# Обработчик ответов: callback_data подписана и несет сессию, позицию, вопрос и выбранный вариант
+@router.callback_query(AnswerCallback.filter())
+async def handle_answer(callback: types.CallbackQuery, callback_data: AnswerCallback):
+    user_id: int = callback.from_user.id
+    if breaker.state == "open":
+        # База недоступна: сразу отвечаем на нажатие, не дожидаясь таймаутов
+        logger.warning(f"User {user_id}: Answer shed, YDB circuit breaker is open.")
+        await callback.answer(TRY_LATER_TEXT)
+        return
+    if not callback_data.is_valid():
+        logger.warning(f"User {user_id}: Answer callback with invalid signature {callback.data!r}.")
+        await callback.answer()
+        return
+    # Банк из YDB должен быть загружен до проверки ответа
+    await ensure_loaded()
+    question = bank.get(callback_data.question)
+    if question is None or question.id != bank.question_at(callback_data.session, callback_data.position).id:
+        # Вопрос не совпадает с последовательностью сессии (например, банк вопросов поменялся)
+        logger.warning(f"User {user_id}: Answer callback does not match question bank {callback.data!r}.")
+        await callback.answer(STALE_ANSWER_TEXT)
+        return
+    logger.debug(f"User {user_id}: Received answer {callback_data.option} for question {question.id}.")
+    await process_answer(callback, callback_data, question)
+
+
+# Вопрос квиза на время остался без ответа: вызывается планировщиком expiry или обходом по таймер-триггеру.
+# cmd_timed запускает квиз только в личном чате, поэтому chat_id совпадает с user_id
+async def expire_question(bot: Bot, user_id: int, session_id: int, question_index: int):
+    store = await get_store()
+    if store is None:
+        # Строка останется в выборке истекших, ее подберет следующий обход
+        logger.warning(f"User {user_id}: Quiz state store is unavailable, question {question_index} expiry postponed.")
+        return
+    await ensure_loaded()
+    message_id = await get_last_question_message_id(store, user_id)
+    try:
+        progress = await advance_quiz(store, user_id, False, session_id, question_index, expired=True)
+    except StaleAnswerError:
+        # Успели ответить или начали новый квиз
+        return
+    if progress is None:
+        return
+    question = bank.question_at(session_id, question_index)
+    await results.record_answer(question.id, False)
+    logger.info(f"User {user_id}: Question {question_index} of session {session_id} expired.")
+
+    async def remove_keyboard():
+        if not message_id:
+            return
+        try:
+            await bot.edit_message_reply_markup(chat_id=user_id, message_id=message_id, reply_markup=None)
+        except Exception as e:
+            logger.warning(f"User {user_id}: Failed to edit message reply markup {message_id}: {e}")
+
+    reply = _reply_and_continue(store, bot, user_id, user_id, f"Время вышло! Правильный ответ: {question.correct_option_text}", progress)
+    if progress.finished:
+        # Имени пользователя без апдейта нет, в таблице лидеров будет показан его id
+        record = results.record_run(user_id, "", progress.session_id, progress.score, progress.quiz_length)
+        await asyncio.gather(remove_keyboard(), reply, record)
     else:
-        total_score: int = await get_user_score(pool, user_id)
-        await reset_user_quiz_state(pool, user_id)
-        # Обнуляем message_id в БД при завершении квиза
-        await update_last_question_message_id(pool, user_id, 0)
-        await callback.message.answer(f"Это был последний вопрос! Ваш результат: {total_score} правильных ответов из 10.")
-    await callback.answer() # Отвечаем на колбэк
+        await asyncio.gather(remove_keyboard(), reply)
+
+
+# Кнопки старых форматов (right_answer/wrong_answer и т.п.) больше не принимаются
+@router.callback_query()
+async def handle_unknown_callback(callback: types.CallbackQuery):
+    logger.debug(f"User {callback.from_user.id}: Unknown callback data {callback.data!r}.")
+    await callback.answer(STALE_ANSWER_TEXT)
+
+
+# Хранилище недоступно (открыт автомат отключения или истек дедлайн): вежливо отказываем.
+# Ошибка считается обработанной, поэтому вебхук отвечает 200 и Telegram не шлет апдейт повторно
+@router.errors(ExceptionTypeFilter(StorageUnavailableError))
+async def handle_storage_unavailable(event: types.ErrorEvent):
+    logger.warning(f"Update {event.update.update_id} degraded: {event.exception}")
+    callback = event.update.callback_query
+    message = event.update.message or (callback.message if callback else None)
+    if callback is not None:
+        try:
+            await callback.answer(TRY_LATER_TEXT)
+            return
+        except Exception as e:
+            # На нажатие уже ответили (например, _acknowledge), пишем в чат
+            logger.debug(f"User {callback.from_user.id}: Failed to answer callback query: {e}")
+    if message is not None:
+        try:
+            await message.answer(TRY_LATER_TEXT)
+        except Exception as e:
+            logger.warning(f"Failed to send degraded reply in chat {message.chat.id}: {e}")
@@ -0,0 +1,113 @@
+"""
+Cold-start import profile: imports the entry module in a fresh interpreter with `-X importtime`
+and reports where the time goes, by package and by module.
+
+    python importprofile.py
+    python importprofile.py --module worker --top 30 --json
+    python importprofile.py --budget-ms 900
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+from collections import defaultdict
+from typing import NamedTuple
+
+# Модули бота лежат в корне репозитория, их отличаем от сторонних пакетов
+_LOCAL_MODULES = {name[:-3] for name in os.listdir(os.path.dirname(os.path.abspath(__file__))) if name.endswith('.py')}
+
+
+class ImportRecord(NamedTuple):
+    name: str
+    level: int
+    self_us: int
+    cumulative_us: int
+
+
+def parse_importtime(output: str) -> list[ImportRecord]:
+    # Строка: "import time: <self> | <cumulative> | <отступ по 2 пробела на уровень><модуль>"
+    records = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        try:
+            self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+            self_us, cumulative_us = int(self_us), int(cumulative_us)
+        except ValueError:
+            continue  # заголовок таблицы
+        name = name[1:]
+        stripped = name.lstrip(' ')
+        records.append(ImportRecord(stripped, (len(name) - len(stripped)) // 2, self_us, cumulative_us))
+    return records
+
+
+def profile(module: str) -> list[ImportRecord]:
+    """Imports the module in a child interpreter and returns only the records of its import tree."""
+    env = dict(os.environ)
+    # tb_webhook требует токен при импорте; сеть при импорте не используется
+    env.setdefault("API_TOKEN", "123456:IMPORTPROFILE")
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        env=env, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    records = parse_importtime(completed.stderr)
+    if completed.returncode != 0:
+        errors = [line for line in completed.stderr.splitlines() if not line.startswith('import time:')]
+        raise RuntimeError(f"import {module} failed:\n" + "\n".join(errors[-10:]))
+    # Дочерние модули печатаются раньше родителя: дерево модуля - строки после предыдущего импорта верхнего уровня
+    end = max(i for i, record in enumerate(records) if record.level == 0 and record.name == module)
+    start = max((i for i, record in enumerate(records[:end]) if record.level == 0), default=-1) + 1
+    return records[start:end + 1]
+
+
+def report(records: list[ImportRecord], top: int) -> dict:
+    packages: dict[str, int] = defaultdict(int)
+    for record in records:
+        packages[record.name.split('.')[0]] += record.self_us
+    local = [record for record in records if record.name in _LOCAL_MODULES]
+    return {
+        'module': records[-1].name,
+        'total_ms': round(records[-1].cumulative_us / 1000, 1),
+        'modules_imported': len(records),
+        'packages_ms': {
+            name: round(us / 1000, 1) for name, us in sorted(packages.items(), key=lambda item: -item[1])[:top]
+        },
+        'slowest_modules_ms': {
+            record.name: round(record.self_us / 1000, 1) for record in sorted(records, key=lambda r: -r.self_us)[:top]
+        },
+        # Собственное время модулей бота вместе с тем, что они первыми подтянули
+        'local_modules_cumulative_ms': {
+            record.name: round(record.cumulative_us / 1000, 1) for record in sorted(local, key=lambda r: -r.cumulative_us)
+        },
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Cold-start import time profile")
+    parser.add_argument('--module', default='tb_webhook', help="entry module to import")
+    parser.add_argument('--top', type=int, default=15, help="how many packages and modules to list")
+    parser.add_argument('--budget-ms', type=float, help="exit with code 1 if the import takes longer")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+
+    try:
+        result = report(profile(args.module), args.top)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print(f"import {result['module']}: {result['total_ms']} ms, {result['modules_imported']} modules")
+        for section in ('packages_ms', 'slowest_modules_ms', 'local_modules_cumulative_ms'):
+            print(f"\n{section}:")
+            for name, ms in result[section].items():
+                print(f"{ms:>10.1f}  {name}")
+    if args.budget_ms is not None and result['total_ms'] > args.budget_ms:
+        print(f"Import budget exceeded: {result['total_ms']} ms > {args.budget_ms} ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
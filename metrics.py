@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import random
+import logging
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Доля измерений, которые дополнительно пишутся в лог отдельной JSON-строкой (0 - не писать)
+METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", "0.01"))
+# Как часто (в секундах) писать в лог снимок всех гистограмм, 0 - не писать
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "60"))
+
+# Границы корзин в секундах
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # последняя корзина - +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> float:
+        # Оценка по верхней границе корзины, как histogram_quantile без интерполяции
+        rank = q * self.count
+        seen = 0
+        for bound, bucket_count in zip(BUCKETS, self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """
+    Latency histograms keyed by (stage, name): webhook stages, handlers, YDB statements, Telegram methods.
+    """
+
+    def __init__(self, sample_rate: float = METRICS_SAMPLE_RATE, log_interval: float = METRICS_LOG_INTERVAL):
+        self.sample_rate = sample_rate
+        self.log_interval = log_interval
+        self._histograms: dict[tuple[str, str], Histogram] = {}
+        self._last_log = time.monotonic()
+
+    def observe(self, stage: str, name: str, seconds: float) -> None:
+        histogram = self._histograms.get((stage, name))
+        if histogram is None:
+            histogram = self._histograms[(stage, name)] = Histogram()
+        histogram.observe(seconds)
+        if self.sample_rate and random.random() < self.sample_rate:
+            logger.info(json.dumps({'metric': stage, 'name': name, 'ms': round(seconds * 1000, 3)}))
+
+    @contextmanager
+    def timer(self, stage: str, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, name, time.perf_counter() - started)
+
+    def snapshot(self) -> list[dict]:
+        return [
+            {
+                'stage': stage,
+                'name': name,
+                'count': histogram.count,
+                'sum_ms': round(histogram.sum * 1000, 3),
+                'p50_ms': histogram.quantile(0.5) * 1000,
+                'p95_ms': histogram.quantile(0.95) * 1000,
+                'p99_ms': histogram.quantile(0.99) * 1000,
+            }
+            for (stage, name), histogram in sorted(self._histograms.items())
+        ]
+
+    def maybe_log_snapshot(self) -> None:
+        """Writes all histograms as JSON log lines once per METRICS_LOG_INTERVAL."""
+        if not self.log_interval or time.monotonic() - self._last_log < self.log_interval:
+            return
+        self._last_log = time.monotonic()
+        for item in self.snapshot():
+            logger.info(json.dumps({'metrics_snapshot': item}))
+
+    def render_prometheus(self) -> str:
+        lines = [
+            '# HELP quiz_bot_stage_duration_seconds Latency of bot processing stages.',
+            '# TYPE quiz_bot_stage_duration_seconds histogram',
+        ]
+        for (stage, name), histogram in sorted(self._histograms.items()):
+            labels = f'stage="{stage}",name="{name}"'
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS, histogram.counts):
+                cumulative += bucket_count
+                lines.append(f'quiz_bot_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'quiz_bot_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f'quiz_bot_stage_duration_seconds_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'quiz_bot_stage_duration_seconds_count{{{labels}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
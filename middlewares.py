@@ -0,0 +1,186 @@
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable
+import ydb
+import ydb.aio
+from aiogram import BaseMiddleware, Bot, types
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import TelegramType
+from database import execute_transaction, execute_update_query, get_pool, prepare, query_cache
+from metrics import metrics
+from state_store import QUIZ_STATE_BACKEND
+
+logger = logging.getLogger(__name__)
+
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", "10000"))
+# Дедупликация через YDB нужна, когда повторная доставка может попасть на другой инстанс
+# По умолчанию включена, только если состояние квиза и так хранится в YDB
+UPDATE_DEDUP_YDB = os.getenv("UPDATE_DEDUP_YDB", "1" if QUIZ_STATE_BACKEND == "ydb" else "0") == "1"
+
+_CLAIM_UPDATE_QUERY = """
+    DECLARE $update_id AS Uint64;
+
+    INSERT INTO `processed_updates` (update_id, processed_at)
+    VALUES ($update_id, CurrentUtcTimestamp());
+"""
+
+_RELEASE_UPDATE_QUERY = """
+    DECLARE $update_id AS Uint64;
+
+    DELETE FROM `processed_updates`
+    WHERE update_id == $update_id;
+"""
+
+
+class RecentUpdates:
+    """
+    Bounded set of recently seen update_id values.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items: OrderedDict[int, None] = OrderedDict()
+
+    def add(self, update_id: int) -> bool:
+        """Returns False if the update was already seen."""
+        if update_id in self._items:
+            return False
+        self._items[update_id] = None
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        return True
+
+    def discard(self, update_id: int) -> None:
+        self._items.pop(update_id, None)
+
+
+class KeyedLocks:
+    """
+    Per-key asyncio locks; a lock lives only while someone holds or waits for it.
+    """
+
+    def __init__(self):
+        self._locks: dict[Any, list] = {}  # key -> [lock, число владельцев и ожидающих]
+
+    @asynccontextmanager
+    async def hold(self, key):
+        slot = self._locks.get(key)
+        if slot is None:
+            slot = self._locks[key] = [asyncio.Lock(), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                yield
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0:
+                del self._locks[key]
+
+
+async def claim_update(pool: ydb.aio.SessionPool, update_id: int) -> bool:
+    """
+    Atomically records the update in YDB; returns False if it was already processed.
+    INSERT падает с PreconditionFailed на существующем ключе, поэтому проверка и запись - один запрос.
+    """
+    async def callee(session: ydb.aio.table.Session):
+        tx_context = session.transaction(ydb.SerializableReadWrite())
+        try:
+            await tx_context.execute(await prepare(session, _CLAIM_UPDATE_QUERY), {'$update_id': update_id}, commit_tx=True)
+            return True
+        except ydb.PreconditionFailed:
+            return False
+        except Exception:
+            query_cache.discard(session, _CLAIM_UPDATE_QUERY)
+            await tx_context.rollback()
+            raise
+
+    return await execute_transaction(pool, callee, query_name="claim_update")
+
+
+async def release_update(pool: ydb.aio.SessionPool, update_id: int) -> None:
+    # Снимаем отметку, чтобы повторная доставка после ошибки обработалась заново
+    await execute_update_query(pool, _RELEASE_UPDATE_QUERY, query_name="release_update", update_id=update_id)
+
+
+class UpdateOrderingMiddleware(BaseMiddleware):
+    """
+    Outer update middleware: drops duplicate deliveries and processes updates
+    of one user strictly one at a time, different users in parallel.
+    """
+
+    def __init__(self, dedup_size: int = UPDATE_DEDUP_SIZE, use_ydb: bool = UPDATE_DEDUP_YDB):
+        self.recent = RecentUpdates(dedup_size)
+        self.locks = KeyedLocks()
+        self.use_ydb = use_ydb
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: types.Update,
+        data: dict[str, Any],
+    ) -> Any:
+        update_id = event.update_id
+        if not self.recent.add(update_id):
+            logger.info(f"Duplicate update {update_id} dropped (in-memory).")
+            return None
+
+        claimed_in_ydb = False
+        if self.use_ydb:
+            try:
+                pool = await get_pool()
+                if pool is not None:
+                    if not await claim_update(pool, update_id):
+                        logger.info(f"Duplicate update {update_id} dropped (YDB).")
+                        return None
+                    claimed_in_ydb = True
+            except Exception as e:
+                # Дедупликация не должна ронять обработку, если YDB недоступна
+                logger.warning(f"Failed to check update {update_id} in YDB, processing anyway: {e}")
+
+        # UserContextMiddleware диспетчера уже положил отправителя в data
+        user = data.get('event_from_user')
+        try:
+            if user is None:
+                return await handler(event, data)
+            async with self.locks.hold(user.id):
+                return await handler(event, data)
+        except Exception:
+            self.recent.discard(update_id)
+            if claimed_in_ydb:
+                try:
+                    await release_update(await get_pool(), update_id)
+                except Exception as e:
+                    logger.warning(f"Failed to release update {update_id} in YDB: {e}")
+            raise
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Inner router middleware: times each handler by its function name."""
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object is not None else type(event).__name__
+        with metrics.timer('handler', name):
+            return await handler(event, data)
+
+
+class TelegramTimingMiddleware(BaseRequestMiddleware):
+    """Bot session middleware: times each Telegram API call by method name."""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ):
+        with metrics.timer('telegram', method.__api_method__):
+            return await make_request(bot, method)
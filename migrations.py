@@ -0,0 +1,311 @@
+"""
+Versioned YDB schema migrations. Applied versions are recorded in `schema_migrations`;
+every statement is safe to repeat, so a partially applied or concurrent run can simply be restarted.
+
+    python migrations.py            # применить недостающие миграции
+    python migrations.py --status   # показать примененные и ожидающие
+    python migrations.py --dry-run  # напечатать DDL ожидающих миграций, ничего не меняя
+"""
+import os
+import sys
+import asyncio
+import logging
+import argparse
+from typing import NamedTuple
+import ydb
+import ydb.aio
+import database
+from database import execute_select_records, execute_update_query
+
+logger = logging.getLogger(__name__)
+
+# Заполнение новых колонок в существующих строках: строк за запрос (не больше лимита выдачи YDB в 1000) и пауза между запросами
+MIGRATION_BACKFILL_BATCH = int(os.getenv("MIGRATION_BACKFILL_BATCH", "1000"))
+MIGRATION_BACKFILL_PAUSE = float(os.getenv("MIGRATION_BACKFILL_PAUSE", "0.1"))
+
+
+class Backfill(NamedTuple):
+    """Stamps updated_at on the table's rows that do not have it yet."""
+    table: str
+    key: tuple[tuple[str, str], ...]  # (колонка, тип YDB) в порядке первичного ключа
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    statements: tuple[str, ...]
+    backfills: tuple[Backfill, ...] = ()
+
+
+# Порядок и содержимое примененных миграций не меняются: новая схема - новая миграция в конце списка.
+# Первые версии повторяют историю sql.txt, поэтому база, созданная по любой его версии, догоняется до текущей
+MIGRATIONS: tuple[Migration, ...] = (
+    Migration(1, "create quiz_state", ("""
+        CREATE TABLE `quiz_state` (
+            user_id Uint64,
+            question_index Uint64,
+            score Uint64,
+            last_question_message_id Uint64,
+            PRIMARY KEY (`user_id`)
+        );
+    """,)),
+    Migration(2, "quiz_state version for optimistic flushes", (
+        "ALTER TABLE `quiz_state` ADD COLUMN version Uint64;",
+    )),
+    Migration(3, "question bank and quiz sessions", (
+        "ALTER TABLE `quiz_state` ADD COLUMN session_id Uint64;",
+        """
+        CREATE TABLE `questions` (
+            id Uint64,
+            topic Utf8,
+            difficulty Uint32,
+            question Utf8,
+            options Utf8,
+            correct_option Uint32,
+            PRIMARY KEY (`id`)
+        );
+        """,
+    )),
+    Migration(4, "processed updates for dedup", ("""
+        CREATE TABLE `processed_updates` (
+            update_id Uint64,
+            processed_at Timestamp,
+            PRIMARY KEY (`update_id`)
+        )
+        WITH (TTL = Interval("P1D") ON processed_at);
+    """,)),
+    Migration(5, "results, leaderboard and question stats", (
+        """
+        CREATE TABLE `quiz_results` (
+            user_id Uint64,
+            session_id Uint64,
+            scope Utf8,
+            score Uint64,
+            quiz_length Uint64,
+            finished_at Timestamp,
+            PRIMARY KEY (`user_id`, `session_id`)
+        );
+        """,
+        """
+        CREATE TABLE `leaderboard` (
+            scope Utf8,
+            user_id Uint64,
+            name Utf8,
+            score Uint64,
+            quiz_length Uint64,
+            achieved_at Timestamp,
+            PRIMARY KEY (`scope`, `user_id`)
+        );
+        """,
+        """
+        CREATE TABLE `question_stats` (
+            question_id Uint64,
+            answered Uint64,
+            correct Uint64,
+            PRIMARY KEY (`question_id`)
+        );
+        """,
+    )),
+    Migration(6, "timed quiz mode", (
+        "ALTER TABLE `quiz_state` ADD COLUMN time_limit Uint32;",
+        "ALTER TABLE `quiz_state` ADD COLUMN question_sent_at Uint64;",
+        "ALTER TABLE `quiz_state` ADD INDEX `idx_question_sent_at` GLOBAL ON (`question_sent_at`);",
+    )),
+    Migration(7, "group quiz scores", ("""
+        CREATE TABLE `group_scores` (
+            chat_id Int64,
+            session_id Uint64,
+            user_id Uint64,
+            name Utf8,
+            score Uint64,
+            PRIMARY KEY (`chat_id`, `session_id`, `user_id`)
+        );
+    """,)),
+    # Брошенные сессии удаляет сам YDB в фоне. Строки, записанные до миграции, TTL без updated_at не видит:
+    # их возраст неизвестен, поэтому они получают время миграции и дальше истекают как остальные
+    Migration(8, "updated_at and row TTL", (
+        "ALTER TABLE `quiz_state` ADD COLUMN updated_at Timestamp;",
+        'ALTER TABLE `quiz_state` SET (TTL = Interval("P30D") ON updated_at);',
+        "ALTER TABLE `group_scores` ADD COLUMN updated_at Timestamp;",
+        'ALTER TABLE `group_scores` SET (TTL = Interval("P7D") ON updated_at);',
+    ), (
+        Backfill("quiz_state", (("user_id", "Uint64"),)),
+        Backfill("group_scores", (("chat_id", "Int64"), ("session_id", "Uint64"), ("user_id", "Uint64"))),
+    )),
+)
+
+_CREATE_MIGRATIONS_TABLE = """
+    CREATE TABLE `schema_migrations` (
+        version Uint32,
+        name Utf8,
+        applied_at Timestamp,
+        PRIMARY KEY (`version`)
+    );
+"""
+
+_LOAD_APPLIED_QUERY = """
+    SELECT version FROM `schema_migrations`;
+"""
+
+_RECORD_MIGRATION_QUERY = """
+    DECLARE $version AS Uint32;
+    DECLARE $name AS Utf8;
+
+    UPSERT INTO `schema_migrations` (version, name, applied_at)
+    VALUES ($version, $name, CurrentUtcTimestamp());
+"""
+
+# DDL идет мимо resilience.call_with_retries: построение индекса дольше дедлайна обычного запроса
+_SCHEME_RETRY_SETTINGS = ydb.RetrySettings(max_retries=3)
+
+
+async def execute_scheme(pool: ydb.aio.SessionPool, statement: str) -> bool:
+    """Runs one DDL statement; returns False if its object already exists, i.e. it was applied before."""
+    async def callee(session: ydb.aio.table.Session):
+        await session.execute_scheme(statement)
+
+    try:
+        await pool.retry_operation(callee, retry_settings=_SCHEME_RETRY_SETTINGS)
+    except ydb.Error as e:
+        if "already exist" in str(e).lower():
+            return False
+        raise
+    return True
+
+
+async def table_exists(pool: ydb.aio.SessionPool, table: str) -> bool:
+    async def callee(session: ydb.aio.table.Session) -> bool:
+        try:
+            await session.describe_table(f"{database.YDB_DATABASE}/{table}")
+        except (ydb.SchemeError, ydb.NotFound):
+            return False
+        return True
+
+    return await pool.retry_operation(callee, retry_settings=_SCHEME_RETRY_SETTINGS)
+
+
+async def applied_versions(pool: ydb.aio.SessionPool) -> set[int]:
+    """Versions recorded in schema_migrations; only reads, so --status and --dry-run change nothing."""
+    if not await table_exists(pool, "schema_migrations"):
+        # Миграции еще не запускались
+        return set()
+    return set(await execute_select_records(pool, _LOAD_APPLIED_QUERY, lambda row: row['version'], query_name="load_migrations"))
+
+
+def _after_key(key: tuple[tuple[str, str], ...]) -> str:
+    # Строки строго после ключа $-параметров в порядке первичного ключа: (a, b) > ($a, $b)
+    column = key[0][0]
+    if len(key) == 1:
+        return f"{column} > ${column}"
+    return f"({column} > ${column} OR ({column} == ${column} AND {_after_key(key[1:])}))"
+
+
+async def backfill_updated_at(pool: ydb.aio.SessionPool, backfill: Backfill) -> int:
+    """
+    Stamps updated_at on rows without it, in primary key order and bounded batches.
+    Каждая пачка читается с места, где остановилась предыдущая, поэтому таблица просматривается один раз.
+    Returns the number of stamped rows.
+    """
+    columns = ", ".join(column for column, _ in backfill.key)
+    declares = "".join(f"DECLARE ${column} AS {type_};\n" for column, type_ in backfill.key)
+    select = f"""
+        DECLARE $limit AS Uint64;
+        {{declares}}
+        SELECT {columns}
+        FROM `{backfill.table}`
+        WHERE updated_at IS NULL {{after}}
+        ORDER BY {columns}
+        LIMIT $limit;
+    """
+    first_query = select.format(declares="", after="")
+    next_query = select.format(declares=declares, after=f"AND {_after_key(backfill.key)}")
+    update_query = f"""
+        DECLARE $keys AS List<Struct<{", ".join(f"{column}: {type_}" for column, type_ in backfill.key)}>>;
+
+        UPDATE `{backfill.table}` ON
+        SELECT {columns}, CurrentUtcTimestamp() AS updated_at
+        FROM AS_TABLE($keys);
+    """
+
+    def key_from_row(row) -> dict:
+        return {column: row[column] for column, _ in backfill.key}
+
+    stamped = 0
+    after: dict | None = None
+    while True:
+        if after is None:
+            keys = await execute_select_records(pool, first_query, key_from_row, query_name=f"backfill {backfill.table}",
+                                                limit=MIGRATION_BACKFILL_BATCH)
+        else:
+            keys = await execute_select_records(pool, next_query, key_from_row, query_name=f"backfill {backfill.table}",
+                                                limit=MIGRATION_BACKFILL_BATCH, **after)
+        if not keys:
+            break
+        # UPDATE ON не создает строк: удаленные за это время строки пропускаются
+        await execute_update_query(pool, update_query, query_name=f"stamp {backfill.table}", keys=keys)
+        stamped += len(keys)
+        after = keys[-1]
+        if len(keys) < MIGRATION_BACKFILL_BATCH:
+            break
+        await asyncio.sleep(MIGRATION_BACKFILL_PAUSE)
+    logger.info(f"Backfill of {backfill.table}: updated_at stamped on {stamped} rows.")
+    return stamped
+
+
+def pending(applied: set[int]) -> list[Migration]:
+    return [migration for migration in MIGRATIONS if migration.version not in applied]
+
+
+async def migrate(pool: ydb.aio.SessionPool) -> list[Migration]:
+    """Applies pending migrations in order and returns them."""
+    done = []
+    await execute_scheme(pool, _CREATE_MIGRATIONS_TABLE)
+    for migration in pending(await applied_versions(pool)):
+        for statement in migration.statements:
+            if not await execute_scheme(pool, statement):
+                logger.info(f"Migration {migration.version}: object already exists, statement skipped.")
+        # Версия записывается после заполнения: прерванный запуск повторит его с начала
+        for backfill in migration.backfills:
+            await backfill_updated_at(pool, backfill)
+        await execute_update_query(pool, _RECORD_MIGRATION_QUERY, query_name="record_migration",
+                                   version=migration.version, name=migration.name)
+        logger.info(f"Migration {migration.version} ({migration.name}) applied.")
+        done.append(migration)
+    return done
+
+
+async def main_async(args) -> int:
+    database.connection.start()
+    try:
+        pool = await database.get_pool()
+        if pool is None:
+            print("YDB is unavailable: check YDB_ENDPOINT and YDB_DATABASE.", file=sys.stderr)
+            return 2
+        if args.status or args.dry_run:
+            applied = await applied_versions(pool)
+            for migration in MIGRATIONS:
+                mark = "applied" if migration.version in applied else "pending"
+                print(f"{migration.version:>4}  {mark:<8} {migration.name}")
+                if args.dry_run and migration.version not in applied:
+                    for statement in migration.statements:
+                        print(f"      {statement.strip()}")
+                    for backfill in migration.backfills:
+                        print(f"      -- backfill updated_at in {backfill.table}")
+            return 0
+        done = await migrate(pool)
+        print(f"Applied {len(done)} migrations, schema version {MIGRATIONS[-1].version}.")
+        return 0
+    finally:
+        await database.connection.close()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="YDB schema migrations for the quiz bot")
+    parser.add_argument('--status', action='store_true', help="list applied and pending migrations")
+    parser.add_argument('--dry-run', action='store_true', help="print pending DDL without applying it")
+    sys.exit(asyncio.run(main_async(parser.parse_args())))
+
+
+if __name__ == '__main__':
+    main()
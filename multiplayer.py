@@ -0,0 +1,206 @@
+import os
+import random
+import logging
+from abc import ABC, abstractmethod
+from typing import NamedTuple
+import ydb.aio
+import database
+from database import execute_select_records, execute_update_query
+from expiry import ExpiryScheduler, now_ms
+from question_bank import bank
+from state_store import QUIZ_STATE_BACKEND
+
+logger = logging.getLogger(__name__)
+
+# Групповой квиз: очки участников хранятся там же, где quiz_state (ydb), иначе - в памяти процесса
+GROUP_QUIZ_BACKEND = os.getenv("GROUP_QUIZ_BACKEND", "ydb" if QUIZ_STATE_BACKEND == "ydb" else "memory")
+# Раунды живут в памяти процесса и закрываются его таймером, поэтому режим включается только в постоянном процессе:
+# worker.py задает GROUP_QUIZ_ENABLED=1, в облачной функции инстанс между вызовами заморожен и раунд не закрылся бы
+GROUP_QUIZ_ENABLED = os.getenv("GROUP_QUIZ_ENABLED", "0") == "1"
+# Сколько секунд длится раунд: все ответы за это время копятся в памяти и пишутся одним запросом
+GROUP_ROUND_SECONDS = int(os.getenv("GROUP_ROUND_SECONDS", "20"))
+# Сколько строк итоговой таблицы показывать
+GROUP_STANDINGS_SIZE = int(os.getenv("GROUP_STANDINGS_SIZE", "10"))
+
+
+class PlayerScore(NamedTuple):
+    user_id: int
+    name: str
+    score: int
+
+
+class Round:
+    """
+    One open question of a group quiz. Ответы только копятся в памяти: нажатие не обращается к хранилищу.
+    """
+    __slots__ = ('chat_id', 'session_id', 'question_index', 'message_id', 'answers')
+
+    def __init__(self, chat_id: int, session_id: int, question_index: int, message_id: int):
+        self.chat_id = chat_id
+        self.session_id = session_id
+        self.question_index = question_index
+        self.message_id = message_id
+        # user_id -> (имя, ответ верный); засчитывается первое нажатие
+        self.answers: dict[int, tuple[str, bool]] = {}
+
+    def deltas(self) -> list[PlayerScore]:
+        return [PlayerScore(user_id, name, 1 if correct else 0) for user_id, (name, correct) in self.answers.items()]
+
+
+class GroupStore(ABC):
+    """Scores of group quiz sessions, keyed by (chat_id, session_id, user_id)."""
+
+    @abstractmethod
+    async def add_scores(self, chat_id: int, session_id: int, deltas: list[PlayerScore]) -> None:
+        """Adds the round's points of every participant in one write."""
+
+    @abstractmethod
+    async def load_scores(self, chat_id: int, session_id: int, limit: int) -> list[PlayerScore]:
+        """Returns the session's best scores, highest first."""
+
+
+# Очки раунда прибавляются к накопленным одним запросом, без чтения строк на стороне бота
+_ADD_SCORES_QUERY = """
+    DECLARE $chat_id AS Int64;
+    DECLARE $session_id AS Uint64;
+    DECLARE $deltas AS List<Struct<user_id: Uint64, name: Utf8, score: Uint64>>;
+
+    $current = (
+        SELECT user_id, score
+        FROM `group_scores`
+        WHERE chat_id == $chat_id AND session_id == $session_id
+    );
+
+    UPSERT INTO `group_scores`
+    SELECT
+        $chat_id AS chat_id,
+        $session_id AS session_id,
+        d.user_id AS user_id,
+        d.name AS name,
+        COALESCE(c.score, 0ul) + d.score AS score,
+        CurrentUtcTimestamp() AS updated_at
+    FROM AS_TABLE($deltas) AS d
+    LEFT JOIN $current AS c ON c.user_id = d.user_id;
+"""
+
+_LOAD_SCORES_QUERY = """
+    DECLARE $chat_id AS Int64;
+    DECLARE $session_id AS Uint64;
+    DECLARE $limit AS Uint64;
+
+    SELECT user_id, name, score
+    FROM `group_scores`
+    WHERE chat_id == $chat_id AND session_id == $session_id
+    ORDER BY score DESC
+    LIMIT $limit;
+"""
+
+
+def _score_from_row(row) -> PlayerScore:
+    return PlayerScore(row['user_id'], row['name'] or "", row['score'] or 0)
+
+
+class YdbGroupStore(GroupStore):
+    """Table group_scores in YDB."""
+
+    async def _pool(self) -> ydb.aio.SessionPool:
+        pool = await database.get_pool()
+        if pool is None:
+            raise ConnectionError("YDB pool is unavailable")
+        return pool
+
+    async def add_scores(self, chat_id: int, session_id: int, deltas: list[PlayerScore]) -> None:
+        await execute_update_query(
+            await self._pool(),
+            _ADD_SCORES_QUERY,
+            query_name="add_group_scores",
+            chat_id=chat_id,
+            session_id=session_id,
+            deltas=[delta._asdict() for delta in deltas],
+        )
+
+    async def load_scores(self, chat_id: int, session_id: int, limit: int) -> list[PlayerScore]:
+        return await execute_select_records(
+            await self._pool(), _LOAD_SCORES_QUERY, _score_from_row, query_name="load_group_scores",
+            chat_id=chat_id, session_id=session_id, limit=limit,
+        )
+
+
+class MemoryGroupStore(GroupStore):
+    """Group scores of this process only."""
+
+    def __init__(self):
+        self._scores: dict[tuple[int, int], dict[int, PlayerScore]] = {}
+
+    async def add_scores(self, chat_id: int, session_id: int, deltas: list[PlayerScore]) -> None:
+        scores = self._scores.setdefault((chat_id, session_id), {})
+        for delta in deltas:
+            current = scores.get(delta.user_id)
+            scores[delta.user_id] = PlayerScore(delta.user_id, delta.name, (current.score if current else 0) + delta.score)
+
+    async def load_scores(self, chat_id: int, session_id: int, limit: int) -> list[PlayerScore]:
+        scores = self._scores.get((chat_id, session_id), {})
+        return sorted(scores.values(), key=lambda item: -item.score)[:limit]
+
+
+def create_group_store(backend: str = GROUP_QUIZ_BACKEND) -> GroupStore:
+    if backend == "ydb":
+        return YdbGroupStore()
+    if backend == "memory":
+        return MemoryGroupStore()
+    raise ValueError(f"Unknown GROUP_QUIZ_BACKEND: {backend!r}")
+
+
+group_store = create_group_store()
+
+# Открытые раунды по чатам и их сроки: один таймер на все чаты, как у квиза на время
+_rounds: dict[int, Round] = {}
+round_scheduler = ExpiryScheduler()
+
+
+def new_session_id() -> int:
+    # Seed порядка вопросов группового квиза
+    return random.getrandbits(63)
+
+
+def open_round(chat_id: int, session_id: int, question_index: int, message_id: int) -> Round:
+    """Starts collecting answers to the question; the previous round of the chat, if any, is abandoned."""
+    round_ = _rounds[chat_id] = Round(chat_id, session_id, question_index, message_id)
+    round_scheduler.schedule(chat_id, session_id, question_index, now_ms() + GROUP_ROUND_SECONDS * 1000)
+    return round_
+
+
+def record_answer(chat_id: int, session_id: int, question_index: int, user_id: int, name: str, option: int) -> bool | None:
+    """
+    Records a member's answer in memory.
+    Returns None if the question is not the chat's open round, False if the member has already answered.
+    """
+    round_ = _rounds.get(chat_id)
+    if round_ is None or round_.session_id != session_id or round_.question_index != question_index:
+        return None
+    if user_id in round_.answers:
+        return False
+    question = bank.question_at(session_id, question_index)
+    round_.answers[user_id] = (name[:64], option == question.correct_option)
+    return True
+
+
+def take_round(chat_id: int, session_id: int, question_index: int) -> Round | None:
+    """Closes the round for new answers; None if that round is no longer open (a new quiz was started in the chat)."""
+    round_ = _rounds.get(chat_id)
+    if round_ is None or round_.session_id != session_id or round_.question_index != question_index:
+        return None
+    del _rounds[chat_id]
+    round_scheduler.cancel(chat_id)
+    return round_
+
+
+async def save_round(round_: Round) -> None:
+    """Writes the points of all the round's participants with one query."""
+    if round_.answers:
+        await group_store.add_scores(round_.chat_id, round_.session_id, round_.deltas())
+    logger.info(f"Chat {round_.chat_id}: Round {round_.question_index} closed with {len(round_.answers)} answers.")
+
+
+async def standings(chat_id: int, session_id: int) -> list[PlayerScore]:
+    return await group_store.load_scores(chat_id, session_id, GROUP_STANDINGS_SIZE)
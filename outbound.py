@@ -0,0 +1,232 @@
+import os
+import math
+import time
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod, SendMessage, EditMessageText, EditMessageReplyMarkup, DeleteMessage
+from aiogram.methods.base import TelegramType
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота; в одном чате долго держать больше одного в секунду не стоит.
+# Один ответ - около трех вызовов в чат (снять клавиатуру, отзыв, следующий вопрос; answerCallbackQuery не считается),
+# поэтому бакет чата пропускает ответ в секунду, а запас - серию быстрых ответов подряд.
+# Значение 0 отключает соответствующее ограничение
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_GLOBAL_BURST = float(os.getenv("OUTBOUND_GLOBAL_BURST", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "3"))
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "10"))
+# Сколько чатов помнить; бакет вытесненного чата начинает заново полным
+OUTBOUND_CHAT_BUCKETS = int(os.getenv("OUTBOUND_CHAT_BUCKETS", "10000"))
+# Сколько раз повторять запрос после 429 и сколько секунд retry_after готовы ждать
+OUTBOUND_FLOOD_RETRIES = int(os.getenv("OUTBOUND_FLOOD_RETRIES", "2"))
+OUTBOUND_MAX_FLOOD_WAIT = float(os.getenv("OUTBOUND_MAX_FLOOD_WAIT", "10"))
+
+# Чем меньше число, тем раньше уходит запрос: вопросы и ответы пользователю важнее косметики
+PRIORITY_SEND = 0
+PRIORITY_EDIT = 1
+PRIORITY_DELETE = 2
+
+_PRIORITIES = {
+    SendMessage: PRIORITY_SEND,
+    EditMessageText: PRIORITY_EDIT,
+    EditMessageReplyMarkup: PRIORITY_EDIT,
+    DeleteMessage: PRIORITY_DELETE,
+}
+
+
+class TokenBucket:
+    """
+    Refills `rate` tokens per second up to `burst`; a 429 blocks it until retry_after has passed.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until one token is available."""
+        blocked = max(0.0, self.blocked_until - now)
+        if self.rate <= 0:
+            return blocked
+        self._refill(now)
+        return max(blocked, (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0)
+
+    def take(self, now: float) -> None:
+        if self.rate > 0:
+            self._refill(now)
+            self.tokens -= 1
+
+    def block(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class _Request:
+    __slots__ = ('priority', 'seq', 'chat_id', 'message_id', 'method', 'future')
+
+    def __init__(self, priority: int, seq: int, chat_id, message_id, method: TelegramMethod):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.method = method
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class OutboundSender(BaseRequestMiddleware):
+    """
+    Bot session middleware that throttles chat-bound Bot API calls with per-chat and global token buckets.
+
+    Requests wait in one priority queue: sendMessage goes before keyboard edits, edits before deletions,
+    FIFO within a priority. A queued edit or deletion that a newer request makes pointless
+    (an edit of a message about to be deleted, an older edit of the same keyboard) is dropped
+    and its caller gets True without an API call. On 429 the chat is paused for retry_after and the call is repeated.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = OUTBOUND_GLOBAL_RATE,
+        global_burst: float = OUTBOUND_GLOBAL_BURST,
+        chat_rate: float = OUTBOUND_CHAT_RATE,
+        chat_burst: float = OUTBOUND_CHAT_BURST,
+        max_chats: int = OUTBOUND_CHAT_BUCKETS,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self._chats: OrderedDict[int, TokenBucket] = OrderedDict()
+        self._queue: list[_Request] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._pump_task: asyncio.Task | None = None
+        self.sent = 0
+        self.merged = 0
+        self.flood_waits = 0
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ):
+        priority = _PRIORITIES.get(type(method))
+        chat_id = getattr(method, 'chat_id', None)
+        if priority is None or chat_id is None:
+            # answerCallbackQuery, setWebhook и прочее не ограничиваем
+            return await make_request(bot, method)
+
+        for attempt in range(OUTBOUND_FLOOD_RETRIES + 1):
+            if not await self._admit(priority, chat_id, method):
+                return True
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.flood_waits += 1
+                self._chat_bucket(chat_id).block(e.retry_after)
+                if attempt == OUTBOUND_FLOOD_RETRIES or e.retry_after > OUTBOUND_MAX_FLOOD_WAIT:
+                    raise
+                logger.warning(f"Flood limit in chat {chat_id} on {method.__api_method__}, retry in {e.retry_after} s.")
+                continue
+            self.sent += 1
+            return result
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _admit(self, priority: int, chat_id: int, method: TelegramMethod) -> bool:
+        """Waits for the request's turn; returns False if a newer request made it redundant."""
+        request = _Request(priority, next(self._seq), chat_id, getattr(method, 'message_id', None), method)
+        if not self._merge(request):
+            self.merged += 1
+            return False
+        self._queue.append(request)
+        self._wakeup.set()
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.get_running_loop().create_task(self._pump())
+        started = time.perf_counter()
+        try:
+            admitted = await request.future
+        finally:
+            if request in self._queue:
+                # Вызывающего отменили, пока запрос ждал в очереди
+                self._queue.remove(request)
+        metrics.observe('telegram_queue', method.__api_method__, time.perf_counter() - started)
+        if not admitted:
+            self.merged += 1
+        return admitted
+
+    def _merge(self, request: _Request) -> bool:
+        # Слияние касается только правок и удалений одного и того же сообщения
+        if request.message_id is None or request.priority == PRIORITY_SEND:
+            return True
+        for queued in list(self._queue):
+            if queued.chat_id != request.chat_id or queued.message_id != request.message_id:
+                continue
+            if isinstance(queued.method, DeleteMessage) and not isinstance(request.method, DeleteMessage):
+                # Сообщение и так будет удалено, править его незачем
+                return False
+            if isinstance(request.method, DeleteMessage) or type(queued.method) is type(request.method):
+                # Более новая операция перекрывает ждущую: удаление - любую правку, правка - такую же правку
+                self._queue.remove(queued)
+                if not queued.future.done():
+                    queued.future.set_result(False)
+        return True
+
+    def _next_request(self, now: float) -> tuple[_Request | None, float]:
+        # Первый по приоритету запрос среди чатов, чей бакет готов, и время до готовности остальных
+        best, wait = None, math.inf
+        for request in self._queue:
+            delay = self._chat_bucket(request.chat_id).delay(now)
+            if delay > 0:
+                wait = min(wait, delay)
+            elif best is None or (request.priority, request.seq) < (best.priority, best.seq):
+                best = request
+        return best, wait
+
+    async def _pump(self) -> None:
+        # Один цикл на процесс выдает разрешения; сами запросы идут параллельно
+        while self._queue:
+            self._wakeup.clear()
+            now = time.monotonic()
+            request, wait = self._next_request(now)
+            if request is not None:
+                wait = self.global_bucket.delay(now)
+                if wait <= 0:
+                    self.global_bucket.take(now)
+                    self._chat_bucket(request.chat_id).take(now)
+                    self._queue.remove(request)
+                    if not request.future.done():
+                        request.future.set_result(True)
+                    continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait if wait != math.inf else None)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {'sent': self.sent, 'merged': self.merged, 'flood_waits': self.flood_waits, 'queued': len(self._queue)}
+
+
+# Общий отправитель для bot.session всех точек входа
+sender = OutboundSender()
@@ -0,0 +1,203 @@
+import os
+import json
+import asyncio
+import math
+import logging
+from typing import Iterable, NamedTuple
+import ydb
+import ydb.aio
+from database import execute_transaction, get_pool, quiz_data, YDB_DATABASE
+
+logger = logging.getLogger(__name__)
+
+# Источник вопросов: builtin (database.quiz_data), файл JSONL (QUESTION_BANK_PATH) или таблица YDB `questions`
+QUESTION_BANK_SOURCE = os.getenv("QUESTION_BANK_SOURCE", "file" if os.getenv("QUESTION_BANK_PATH") else "builtin")
+QUESTION_BANK_PATH = os.getenv("QUESTION_BANK_PATH")
+QUIZ_LENGTH = int(os.getenv("QUIZ_LENGTH", "10"))
+QUIZ_TOPIC = os.getenv("QUIZ_TOPIC") or None
+QUIZ_DIFFICULTY = int(os.getenv("QUIZ_DIFFICULTY")) if os.getenv("QUIZ_DIFFICULTY") else None
+
+DEFAULT_TOPIC = "Технологии 21 века"
+
+
+class Question(NamedTuple):
+    id: int  # позиция в банке, используется в callback_data
+    text: str
+    options: tuple[str, ...]
+    correct_option: int
+    topic: str
+    difficulty: int
+
+    @property
+    def correct_option_text(self) -> str:
+        return self.options[self.correct_option]
+
+
+class QuestionBank:
+    """
+    Question storage with topic and difficulty indexes.
+    Последовательность вопросов пользователя задается seed'ом и вычисляется за O(1) на вопрос,
+    без хранения перемешанного списка.
+    """
+
+    def __init__(self):
+        self._questions: list[Question] = []
+        self._by_topic: dict[str, list[int]] = {}
+        self._by_difficulty: dict[int, list[int]] = {}
+        self._by_topic_difficulty: dict[tuple[str, int], list[int]] = {}
+        self._all: list[int] = []
+
+    def __len__(self) -> int:
+        return len(self._questions)
+
+    def add(self, record: dict) -> Question:
+        options = tuple(record['options'])
+        correct_option = int(record['correct_option'])
+        if not options or not 0 <= correct_option < len(options):
+            raise ValueError(f"Invalid correct_option {correct_option} for {len(options)} options")
+        question = Question(
+            id=len(self._questions),
+            text=record['question'],
+            options=options,
+            correct_option=correct_option,
+            topic=record.get('topic') or DEFAULT_TOPIC,
+            difficulty=int(record.get('difficulty') or 1),
+        )
+        self._questions.append(question)
+        self._all.append(question.id)
+        self._by_topic.setdefault(question.topic, []).append(question.id)
+        self._by_difficulty.setdefault(question.difficulty, []).append(question.id)
+        self._by_topic_difficulty.setdefault((question.topic, question.difficulty), []).append(question.id)
+        return question
+
+    def extend(self, records: Iterable[dict]) -> None:
+        for line_no, record in enumerate(records, 1):
+            try:
+                self.add(record)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(f"Skipping invalid question record #{line_no}: {e}")
+
+    def get(self, question_id: int) -> Question | None:
+        if 0 <= question_id < len(self._questions):
+            return self._questions[question_id]
+        return None
+
+    def topics(self) -> list[str]:
+        return list(self._by_topic)
+
+    def ids(self, topic: str | None = None, difficulty: int | None = None) -> list[int]:
+        if topic is not None and difficulty is not None:
+            return self._by_topic_difficulty.get((topic, difficulty), [])
+        if topic is not None:
+            return self._by_topic.get(topic, [])
+        if difficulty is not None:
+            return self._by_difficulty.get(difficulty, [])
+        return self._all
+
+    def quiz_length(self, topic: str | None = QUIZ_TOPIC, difficulty: int | None = QUIZ_DIFFICULTY) -> int:
+        return min(QUIZ_LENGTH, len(self.ids(topic, difficulty)))
+
+    def question_at(self, seed: int, position: int, topic: str | None = QUIZ_TOPIC, difficulty: int | None = QUIZ_DIFFICULTY) -> Question:
+        """
+        Returns the question at the given position of the sequence defined by seed.
+        Перестановка аффинная: (a * position + b) mod n, где a взаимно просто с n, поэтому вопросы не повторяются.
+        """
+        ids = self.ids(topic, difficulty)
+        n = len(ids)
+        if n == 0:
+            raise IndexError("Question bank has no questions for this selection")
+        a = seed % n or 1
+        while math.gcd(a, n) != 1:
+            a += 1
+        b = (seed >> 32) % n
+        return self._questions[ids[(a * position + b) % n]]
+
+    def replace_with(self, other: "QuestionBank") -> None:
+        # Подменяем содержимое на месте, чтобы ссылки на модульный bank оставались рабочими
+        self._questions = other._questions
+        self._by_topic = other._by_topic
+        self._by_difficulty = other._by_difficulty
+        self._by_topic_difficulty = other._by_topic_difficulty
+        self._all = other._all
+
+    @classmethod
+    def from_records(cls, records: Iterable[dict]) -> "QuestionBank":
+        bank = cls()
+        bank.extend(records)
+        return bank
+
+    @classmethod
+    def from_jsonl(cls, path: str) -> "QuestionBank":
+        # Файл читается построчно, целиком в память не загружается
+        return cls.from_records(_iter_jsonl(path))
+
+
+def _iter_jsonl(path: str):
+    with open(path, encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping malformed JSON on line {line_no} of {path}")
+
+
+async def load_from_ydb(pool: ydb.aio.SessionPool, table: str = "questions") -> QuestionBank:
+    """
+    Streams the `questions` table with read_table, chunk by chunk.
+    """
+    async def callee(session: ydb.aio.table.Session) -> QuestionBank:
+        # Банк создается внутри callee, чтобы повтор после ошибки не дублировал вопросы
+        loaded = QuestionBank()
+        async for result_set in await session.read_table(f"{YDB_DATABASE}/{table}", ordered=True):
+            loaded.extend(
+                {
+                    'question': row.question,
+                    'options': json.loads(row.options),
+                    'correct_option': row.correct_option,
+                    'topic': row.topic,
+                    'difficulty': row.difficulty,
+                }
+                for row in result_set.rows
+            )
+        return loaded
+
+    loaded = await execute_transaction(pool, callee, query_name="load_questions")
+    logger.info(f"Loaded {len(loaded)} questions from YDB table {table}.")
+    return loaded
+
+
+def _load_initial() -> QuestionBank:
+    if QUESTION_BANK_SOURCE == "file" and QUESTION_BANK_PATH:
+        loaded = QuestionBank.from_jsonl(QUESTION_BANK_PATH)
+        logger.info(f"Loaded {len(loaded)} questions from {QUESTION_BANK_PATH}.")
+        return loaded
+    # Для источника ydb банк наполняется позже в ensure_loaded(), до этого работают встроенные вопросы
+    return QuestionBank.from_records(quiz_data)
+
+
+bank: QuestionBank = _load_initial()
+_ydb_loaded = False
+# Одновременные первые апдейты холодного инстанса ждут одну загрузку, а не читают таблицу каждый сам
+_ydb_load_lock = asyncio.Lock()
+
+
+async def ensure_loaded() -> QuestionBank:
+    """Loads the YDB question bank on first use when QUESTION_BANK_SOURCE=ydb."""
+    global _ydb_loaded
+    if QUESTION_BANK_SOURCE != "ydb" or _ydb_loaded:
+        return bank
+    async with _ydb_load_lock:
+        if _ydb_loaded:
+            return bank
+        pool = await get_pool()
+        if pool is None:
+            # Без подключения отвечаем по текущему банку и пробуем снова при следующем апдейте
+            return bank
+        loaded = await load_from_ydb(pool)
+        if len(loaded):
+            bank.replace_with(loaded)
+        _ydb_loaded = True
+    return bank
@@ -0,0 +1,88 @@
+import os
+import hmac
+import base64
+import hashlib
+from typing import NamedTuple
+from aiogram import types
+from aiogram.filters.callback_data import CallbackData
+from question_bank import bank, Question
+
+# Ключ подписи callback_data. По умолчанию выводится из токена бота
+CALLBACK_SECRET = (os.getenv("CALLBACK_SECRET") or os.getenv("API_TOKEN") or "").encode()
+_SIGNING_KEY = hashlib.sha256(b"quiz-callback:" + CALLBACK_SECRET).digest()
+
+
+def _sign(prefix: str, session: int, position: int, question: int, option: int) -> str:
+    # Префикс входит в подпись: кнопку личного квиза нельзя выдать за кнопку группового, заменив a: на g:
+    message = f"{prefix}:{session}:{position}:{question}:{option}".encode()
+    digest = hmac.new(_SIGNING_KEY, message, hashlib.sha256).digest()[:6]
+    return base64.urlsafe_b64encode(digest).decode()
+
+
+class AnswerCallback(CallbackData, prefix="a"):
+    """
+    Answer button data: quiz session, position in the quiz, bank question id and chosen option.
+    Подпись не дает подделать ответ, а session/position позволяют отсечь устаревшие нажатия без чтения из YDB.
+    Упакованная строка укладывается в лимит Telegram в 64 байта.
+    """
+    session: int
+    position: int
+    question: int
+    option: int
+    sig: str
+
+    @classmethod
+    def signed(cls, session: int, position: int, question: int, option: int) -> "AnswerCallback":
+        return cls(session=session, position=position, question=question, option=option,
+                   sig=_sign(cls.__prefix__, session, position, question, option))
+
+    def is_valid(self) -> bool:
+        expected = _sign(self.__prefix__, self.session, self.position, self.question, self.option)
+        return hmac.compare_digest(expected, self.sig)
+
+
+class GroupAnswerCallback(AnswerCallback, prefix="g"):
+    """
+    Answer button of a group quiz round. Свой префикс: нажатия в раундах не попадают в хэндлер личного квиза,
+    а ответы личного квиза, начатого в группе, - в хэндлер раундов.
+    """
+
+
+class QuestionPayload(NamedTuple):
+    """
+    Ready-to-send question for one quiz session.
+    """
+    question: Question
+    text: str
+    reply_markup: types.InlineKeyboardMarkup
+
+    @property
+    def correct_option(self) -> int:
+        return self.question.correct_option
+
+    @property
+    def correct_option_text(self) -> str:
+        return self.question.correct_option_text
+
+
+def generate_options_keyboard(
+    question: Question, session_id: int, position: int, callback: type[AnswerCallback] = AnswerCallback,
+) -> types.InlineKeyboardMarkup:
+    # Кнопки подписаны для конкретной сессии и позиции, поэтому клавиатура строится на каждую отправку
+    return types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(
+            text=option,
+            callback_data=callback.signed(session_id, position, question.id, option_index).pack(),
+        )]
+        for option_index, option in enumerate(question.options)
+    ])
+
+
+def payload_at(session_id: int, position: int, callback: type[AnswerCallback] = AnswerCallback) -> QuestionPayload:
+    """Payload of the question at the given position of the session's sequence."""
+    question = bank.question_at(session_id, position)
+    return QuestionPayload(
+        question=question,
+        text=question.text,
+        reply_markup=generate_options_keyboard(question, session_id, position, callback),
+    )
@@ -0,0 +1,149 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+import ydb
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд дается одному обращению к YDB вместе со всеми повторами
+YDB_CALL_DEADLINE = float(os.getenv("YDB_CALL_DEADLINE", "3"))
+YDB_MAX_RETRIES = int(os.getenv("YDB_MAX_RETRIES", "5"))
+# Экспоненциальная задержка между повторами с полным джиттером: random(0, min(cap, base * 2^n))
+YDB_BACKOFF_BASE = float(os.getenv("YDB_BACKOFF_BASE", "0.05"))
+YDB_BACKOFF_CAP = float(os.getenv("YDB_BACKOFF_CAP", "1"))
+# Бюджет повторов: каждый вызов добавляет RATIO токена, повтор тратит один, копится не больше MAX
+YDB_RETRY_BUDGET_RATIO = float(os.getenv("YDB_RETRY_BUDGET_RATIO", "0.2"))
+YDB_RETRY_BUDGET_MAX = float(os.getenv("YDB_RETRY_BUDGET_MAX", "20"))
+# Автомат отключения: после THRESHOLD неудачных вызовов подряд YDB не трогаем COOLDOWN секунд
+YDB_BREAKER_THRESHOLD = int(os.getenv("YDB_BREAKER_THRESHOLD", "5"))
+YDB_BREAKER_COOLDOWN = float(os.getenv("YDB_BREAKER_COOLDOWN", "10"))
+
+# Ошибки доступности, после которых имеет смысл повторить запрос.
+# Undetermined не повторяем: запрос мог закоммититься, а INSERT при повторе вернет ложный конфликт
+RETRIABLE_ERRORS = (
+    ydb.Aborted,
+    ydb.Unavailable,
+    ydb.Overloaded,
+    ydb.BadSession,
+    ydb.SessionExpired,
+    ydb.SessionBusy,
+    ydb.ConnectionError,
+    ydb.Timeout,
+    asyncio.TimeoutError,
+)
+
+
+class StorageUnavailableError(Exception):
+    """The database is unhealthy or did not answer in time; the caller should degrade instead of waiting."""
+
+
+class CircuitBreaker:
+    """
+    Closed -> open after `threshold` consecutive failures -> half-open after `cooldown`:
+    one probe call is let through, its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, threshold: int = YDB_BREAKER_THRESHOLD, cooldown: float = YDB_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info("YDB circuit breaker closed.")
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def release(self) -> None:
+        # Вызов отменен до результата: пробный слот освобождается, состояние не меняется
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self._probe_in_flight or (self.opened_at is None and self.failures >= self.threshold):
+            logger.warning(f"YDB circuit breaker opened after {self.failures} failures, cooldown {self.cooldown} s.")
+            self.opened_at = time.monotonic()
+        self._probe_in_flight = False
+
+
+class RetryBudget:
+    """Token bucket that caps retries to a fraction of calls, so a slow database is not hit by a retry storm."""
+
+    def __init__(self, ratio: float = YDB_RETRY_BUDGET_RATIO, max_tokens: float = YDB_RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def deposit(self) -> None:
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+breaker = CircuitBreaker()
+retry_budget = RetryBudget()
+
+
+def _backoff(attempt: int) -> float:
+    return random.uniform(0, min(YDB_BACKOFF_CAP, YDB_BACKOFF_BASE * 2 ** attempt))
+
+
+async def call_with_retries(operation: Callable[[], Awaitable[Any]], name: str, deadline: float = YDB_CALL_DEADLINE) -> Any:
+    """
+    Runs operation() with a deadline, budgeted backoff retries and the circuit breaker.
+    Raises StorageUnavailableError instead of waiting when YDB is unhealthy; other errors pass through unchanged.
+    """
+    if not breaker.allow():
+        raise StorageUnavailableError(f"YDB circuit breaker is open, {name} skipped")
+    retry_budget.deposit()
+    expires = time.monotonic() + deadline
+    attempt = 0
+    while True:
+        remaining = expires - time.monotonic()
+        try:
+            result = await asyncio.wait_for(operation(), timeout=max(remaining, 0.001))
+        except RETRIABLE_ERRORS as e:
+            delay = _backoff(attempt)
+            attempt += 1
+            if attempt > YDB_MAX_RETRIES or time.monotonic() + delay >= expires or not retry_budget.withdraw():
+                breaker.record_failure()
+                raise StorageUnavailableError(f"{name} failed after {attempt} attempts: {e!r}") from e
+            logger.warning(f"{name}: retriable YDB error {e!r}, retry {attempt} in {delay * 1000:.0f} ms.")
+            await asyncio.sleep(delay)
+            continue
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except Exception:
+            # Логические ошибки (например, PreconditionFailed) означают, что YDB отвечает
+            breaker.record_success()
+            raise
+        breaker.record_success()
+        return result
@@ -0,0 +1,363 @@
+import os
+import time
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from typing import NamedTuple
+import ydb
+import ydb.aio
+import database
+from database import execute_select_query, execute_transaction, execute_update_query, prepare, query_cache
+from question_bank import bank, QUIZ_TOPIC, QUIZ_DIFFICULTY
+from state_store import QUIZ_STATE_BACKEND
+
+logger = logging.getLogger(__name__)
+
+# Завершенные прохождения и агрегаты хранятся там же, где quiz_state (ydb), иначе - в памяти процесса
+RESULTS_BACKEND = os.getenv("RESULTS_BACKEND", "ydb" if QUIZ_STATE_BACKEND == "ydb" else "memory")
+# Сколько мест хранится в каждой таблице лидеров
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", "10"))
+# Раз в сколько секунд перечитывать снимок лидеров и статистики вопросов
+RESULTS_REFRESH_INTERVAL = float(os.getenv("RESULTS_REFRESH_INTERVAL", "60"))
+# Через сколько ответов накопленная статистика вопросов пишется в хранилище. По умолчанию запись на каждый ответ:
+# в облачной функции фоновая запись не успела бы до заморозки инстанса. worker.py копит пачки и дописывает их при остановке
+ANSWER_STATS_FLUSH_EVERY = int(os.getenv("ANSWER_STATS_FLUSH_EVERY", "1"))
+
+GLOBAL_SCOPE = "all"
+
+
+def quiz_scope() -> str:
+    """Leaderboard scope of the configured quiz: topic, difficulty and length."""
+    return f"{QUIZ_TOPIC or '*'}/{QUIZ_DIFFICULTY or '*'}/{bank.quiz_length()}"
+
+
+class LeaderboardEntry(NamedTuple):
+    user_id: int
+    name: str
+    score: int
+    quiz_length: int
+    achieved_at: int  # микросекунды UTC, при равном счете выше тот, кто набрал его раньше
+
+
+class QuestionStats(NamedTuple):
+    question_id: int
+    answered: int
+    correct: int
+
+    @property
+    def accuracy(self) -> float:
+        return self.correct / self.answered if self.answered else 0.0
+
+
+def _rank_key(entry: LeaderboardEntry) -> tuple[int, int]:
+    return -entry.score, entry.achieved_at
+
+
+def merge_top(entries: list[LeaderboardEntry], candidate: LeaderboardEntry, size: int) -> tuple[list[LeaderboardEntry], list[LeaderboardEntry]]:
+    """
+    Applies a finished run to a scope's top list.
+    Returns (rows to upsert, rows to delete); у каждого пользователя в таблице лидеров одна строка - лучший результат.
+    """
+    current = next((entry for entry in entries if entry.user_id == candidate.user_id), None)
+    if current is not None and candidate.score <= current.score:
+        return [], []
+    ranked = sorted([entry for entry in entries if entry is not current] + [candidate], key=_rank_key)
+    upserts = [candidate] if any(entry is candidate for entry in ranked[:size]) else []
+    deletes = [entry for entry in ranked[size:] if entry is not candidate]
+    return upserts, deletes
+
+
+def apply_top(entries: list[LeaderboardEntry], upserts: list[LeaderboardEntry], deletes: list[LeaderboardEntry]) -> list[LeaderboardEntry]:
+    changed = {entry.user_id for entry in upserts} | {entry.user_id for entry in deletes}
+    return sorted([entry for entry in entries if entry.user_id not in changed] + upserts, key=_rank_key)
+
+
+class ResultsStore(ABC):
+    """
+    Storage of completed runs and their incrementally updated aggregates.
+    Ни один метод не читает всю таблицу результатов: лидеры хранятся готовым top-N по каждому scope.
+    """
+
+    @abstractmethod
+    async def record_run(self, user_id: int, session_id: int, scopes: tuple[str, ...], entry: LeaderboardEntry) -> None:
+        ...
+
+    @abstractmethod
+    async def add_answer_stats(self, deltas: dict[int, tuple[int, int]]) -> None:
+        """Adds (answered, correct) counters per question id."""
+
+    @abstractmethod
+    async def load_leaderboards(self, scopes: tuple[str, ...]) -> dict[str, list[LeaderboardEntry]]:
+        ...
+
+    @abstractmethod
+    async def load_question_stats(self) -> dict[int, QuestionStats]:
+        ...
+
+
+_LOAD_TOP_QUERY = """
+    DECLARE $scopes AS List<Utf8>;
+
+    SELECT scope, user_id, name, score, quiz_length, achieved_at
+    FROM `leaderboard`
+    WHERE scope IN $scopes;
+"""
+
+_SAVE_RUN_QUERY = """
+    DECLARE $user_id AS Uint64;
+    DECLARE $session_id AS Uint64;
+    DECLARE $scope AS Utf8;
+    DECLARE $score AS Uint64;
+    DECLARE $quiz_length AS Uint64;
+    DECLARE $finished_at AS Timestamp;
+    DECLARE $upserts AS List<Struct<scope: Utf8, user_id: Uint64, name: Utf8, score: Uint64, quiz_length: Uint64, achieved_at: Timestamp>>;
+    DECLARE $deletes AS List<Struct<scope: Utf8, user_id: Uint64>>;
+
+    UPSERT INTO `quiz_results` (user_id, session_id, scope, score, quiz_length, finished_at)
+    VALUES ($user_id, $session_id, $scope, $score, $quiz_length, $finished_at);
+
+    UPSERT INTO `leaderboard`
+    SELECT * FROM AS_TABLE($upserts);
+
+    DELETE FROM `leaderboard` ON
+    SELECT * FROM AS_TABLE($deletes);
+"""
+
+_ADD_ANSWER_STATS_QUERY = """
+    DECLARE $deltas AS List<Struct<question_id: Uint64, answered: Uint64, correct: Uint64>>;
+
+    UPSERT INTO `question_stats`
+    SELECT
+        d.question_id AS question_id,
+        COALESCE(s.answered, 0ul) + d.answered AS answered,
+        COALESCE(s.correct, 0ul) + d.correct AS correct
+    FROM AS_TABLE($deltas) AS d
+    LEFT JOIN `question_stats` AS s ON s.question_id = d.question_id;
+"""
+
+# Таблица размером с банк вопросов, а не с историю прохождений
+_LOAD_QUESTION_STATS_QUERY = """
+    SELECT question_id, answered, correct
+    FROM `question_stats`;
+"""
+
+
+def _entry_row(scope: str, entry: LeaderboardEntry) -> dict:
+    return {
+        'scope': scope,
+        'user_id': entry.user_id,
+        'name': entry.name,
+        'score': entry.score,
+        'quiz_length': entry.quiz_length,
+        'achieved_at': entry.achieved_at,
+    }
+
+
+def _entry_from_row(row) -> LeaderboardEntry:
+    return LeaderboardEntry(row['user_id'], row['name'] or "", row['score'] or 0, row['quiz_length'] or 0, row['achieved_at'] or 0)
+
+
+class YdbResultsStore(ResultsStore):
+    """Tables quiz_results, leaderboard and question_stats in YDB."""
+
+    async def _pool(self) -> ydb.aio.SessionPool:
+        pool = await database.get_pool()
+        if pool is None:
+            raise ConnectionError("YDB pool is unavailable")
+        return pool
+
+    async def record_run(self, user_id: int, session_id: int, scopes: tuple[str, ...], entry: LeaderboardEntry) -> None:
+        # Чтение top-N затронутых scope и запись результата - одна транзакция из двух запросов
+        async def callee(session: ydb.aio.table.Session):
+            tx_context = session.transaction(ydb.SerializableReadWrite())
+            try:
+                result_sets = await tx_context.execute(await prepare(session, _LOAD_TOP_QUERY), {'$scopes': list(scopes)})
+                boards: dict[str, list[LeaderboardEntry]] = {scope: [] for scope in scopes}
+                for row in (result_sets[0].rows if result_sets else []):
+                    boards[row.scope].append(_entry_from_row(row))
+                upserts, deletes = [], []
+                for scope in scopes:
+                    scope_upserts, scope_deletes = merge_top(boards[scope], entry, LEADERBOARD_SIZE)
+                    upserts.extend(_entry_row(scope, item) for item in scope_upserts)
+                    deletes.extend({'scope': scope, 'user_id': item.user_id} for item in scope_deletes)
+                await tx_context.execute(await prepare(session, _SAVE_RUN_QUERY), {
+                    '$user_id': user_id,
+                    '$session_id': session_id,
+                    '$scope': scopes[-1],
+                    '$score': entry.score,
+                    '$quiz_length': entry.quiz_length,
+                    '$finished_at': entry.achieved_at,
+                    '$upserts': upserts,
+                    '$deletes': deletes,
+                }, commit_tx=True)
+            except Exception:
+                for query in (_LOAD_TOP_QUERY, _SAVE_RUN_QUERY):
+                    query_cache.discard(session, query)
+                await tx_context.rollback()
+                raise
+
+        await execute_transaction(await self._pool(), callee, query_name="record_run")
+
+    async def add_answer_stats(self, deltas: dict[int, tuple[int, int]]) -> None:
+        await execute_update_query(
+            await self._pool(),
+            _ADD_ANSWER_STATS_QUERY,
+            query_name="add_answer_stats",
+            deltas=[
+                {'question_id': question_id, 'answered': answered, 'correct': correct}
+                for question_id, (answered, correct) in deltas.items()
+            ],
+        )
+
+    async def load_leaderboards(self, scopes: tuple[str, ...]) -> dict[str, list[LeaderboardEntry]]:
+        rows = await execute_select_query(await self._pool(), _LOAD_TOP_QUERY, query_name="load_leaderboards", scopes=list(scopes))
+        boards: dict[str, list[LeaderboardEntry]] = {scope: [] for scope in scopes}
+        for row in rows:
+            boards[row['scope']].append(_entry_from_row(row))
+        return {scope: sorted(entries, key=_rank_key) for scope, entries in boards.items()}
+
+    async def load_question_stats(self) -> dict[int, QuestionStats]:
+        rows = await execute_select_query(await self._pool(), _LOAD_QUESTION_STATS_QUERY, query_name="load_question_stats")
+        return {
+            row['question_id']: QuestionStats(row['question_id'], row['answered'] or 0, row['correct'] or 0)
+            for row in rows
+        }
+
+
+class MemoryResultsStore(ResultsStore):
+    """Results of this process only: for the memory and sqlite state backends and benchmarks."""
+
+    def __init__(self):
+        self.runs: list[tuple[int, int, str, LeaderboardEntry]] = []
+        self._boards: dict[str, list[LeaderboardEntry]] = {}
+        self._stats: dict[int, QuestionStats] = {}
+
+    async def record_run(self, user_id: int, session_id: int, scopes: tuple[str, ...], entry: LeaderboardEntry) -> None:
+        self.runs.append((user_id, session_id, scopes[-1], entry))
+        for scope in scopes:
+            board = self._boards.get(scope, [])
+            self._boards[scope] = apply_top(board, *merge_top(board, entry, LEADERBOARD_SIZE))
+
+    async def add_answer_stats(self, deltas: dict[int, tuple[int, int]]) -> None:
+        for question_id, (answered, correct) in deltas.items():
+            current = self._stats.get(question_id) or QuestionStats(question_id, 0, 0)
+            self._stats[question_id] = QuestionStats(question_id, current.answered + answered, current.correct + correct)
+
+    async def load_leaderboards(self, scopes: tuple[str, ...]) -> dict[str, list[LeaderboardEntry]]:
+        return {scope: list(self._boards.get(scope, [])) for scope in scopes}
+
+    async def load_question_stats(self) -> dict[int, QuestionStats]:
+        return dict(self._stats)
+
+
+def create_results_store(backend: str = RESULTS_BACKEND) -> ResultsStore:
+    if backend == "ydb":
+        return YdbResultsStore()
+    if backend == "memory":
+        return MemoryResultsStore()
+    raise ValueError(f"Unknown RESULTS_BACKEND: {backend!r}")
+
+
+class ResultsSnapshot:
+    """
+    In-memory copy of leaderboards and question stats that /top and /stats read.
+    Перечитывается не чаще раза в RESULTS_REFRESH_INTERVAL, между перечитываниями дополняется локальными результатами.
+    """
+
+    def __init__(self):
+        self.leaderboards: dict[str, list[LeaderboardEntry]] = {}
+        self.question_stats: dict[int, QuestionStats] = {}
+        self.refreshed_at: float | None = None
+
+    def stale(self, interval: float) -> bool:
+        return self.refreshed_at is None or time.monotonic() - self.refreshed_at >= interval
+
+    def top(self, scope: str) -> list[LeaderboardEntry]:
+        return self.leaderboards.get(scope, [])
+
+
+results_store = create_results_store()
+snapshot = ResultsSnapshot()
+_refresh_lock = asyncio.Lock()
+# question_id -> [ответов, правильных], еще не записанные в хранилище
+_pending_answers: dict[int, list[int]] = {}
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _spawn(coro) -> None:
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def record_answers(question_id: int, outcomes: list[bool]) -> None:
+    """
+    Counts answers to the question; counters are written in batches of ANSWER_STATS_FLUSH_EVERY answers.
+    При записи на каждый ответ пачка пишется до возврата, иначе - в фоне.
+    """
+    counters = _pending_answers.setdefault(question_id, [0, 0])
+    counters[0] += len(outcomes)
+    counters[1] += sum(outcomes)
+    if sum(answered for answered, _ in _pending_answers.values()) < ANSWER_STATS_FLUSH_EVERY:
+        return
+    if ANSWER_STATS_FLUSH_EVERY <= 1:
+        await flush_answer_stats()
+    else:
+        _spawn(flush_answer_stats())
+
+
+async def record_answer(question_id: int, correct: bool) -> None:
+    await record_answers(question_id, [correct])
+
+
+async def flush_answer_stats() -> None:
+    global _pending_answers
+    if not _pending_answers:
+        return
+    deltas, _pending_answers = _pending_answers, {}
+    try:
+        await results_store.add_answer_stats({question_id: (answered, correct) for question_id, (answered, correct) in deltas.items()})
+    except Exception:
+        logger.error("Failed to write answer stats, keeping them for the next flush.", exc_info=True)
+        for question_id, (answered, correct) in deltas.items():
+            counters = _pending_answers.setdefault(question_id, [0, 0])
+            counters[0] += answered
+            counters[1] += correct
+
+
+async def record_run(user_id: int, name: str, session_id: int, score: int, quiz_length: int) -> None:
+    """Records a completed run and updates the leaderboards; errors are logged, not raised."""
+    entry = LeaderboardEntry(user_id, name[:64], score, quiz_length, int(time.time() * 1_000_000))
+    scopes = (GLOBAL_SCOPE, quiz_scope())
+    try:
+        await asyncio.gather(results_store.record_run(user_id, session_id, scopes, entry), flush_answer_stats())
+    except Exception:
+        logger.error(f"User {user_id}: Failed to record quiz result.", exc_info=True)
+        return
+    # Свой результат виден в /top сразу, не дожидаясь перечитывания снимка
+    for scope in scopes:
+        board = snapshot.leaderboards.get(scope, [])
+        snapshot.leaderboards[scope] = apply_top(board, *merge_top(board, entry, LEADERBOARD_SIZE))
+    logger.info(f"User {user_id}: Quiz result {score}/{quiz_length} recorded.")
+
+
+async def get_snapshot() -> ResultsSnapshot:
+    """Returns the snapshot, re-reading it from the store if it is older than RESULTS_REFRESH_INTERVAL."""
+    if not snapshot.stale(RESULTS_REFRESH_INTERVAL):
+        return snapshot
+    async with _refresh_lock:
+        # Пока ждали блокировку, снимок мог обновить другой хэндлер
+        if not snapshot.stale(RESULTS_REFRESH_INTERVAL):
+            return snapshot
+        try:
+            await flush_answer_stats()
+            leaderboards, question_stats = await asyncio.gather(
+                results_store.load_leaderboards((GLOBAL_SCOPE, quiz_scope())),
+                results_store.load_question_stats(),
+            )
+            snapshot.leaderboards, snapshot.question_stats = leaderboards, question_stats
+        except Exception:
+            # Отдаем прежний снимок и пробуем снова через интервал
+            logger.error("Failed to refresh results snapshot.", exc_info=True)
+        snapshot.refreshed_at = time.monotonic()
+    return snapshot
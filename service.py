@@ -1,210 +1,434 @@
+import os
+import random
+import asyncio
 import logging
-from database import pool, execute_update_query, execute_select_query, quiz_data
-import ydb 
-from aiogram.utils.keyboard import InlineKeyboardBuilder 
-from aiogram import types
+from typing import NamedTuple
+from state_cache import CachedQuizState, QuizStateCache
+from expiry import now_ms, scheduler
+from state_store import QuizStateStore, QuizState, get_store
+from aiogram import Bot, types
+from question_bank import bank
+from question_catalog import payload_at
 
 
 # Заводим логгер
 logger = logging.getLogger(__name__)
 
-
-def generate_options_keyboard(answer_options, right_answer):
-    builder = InlineKeyboardBuilder()
-    for option in answer_options:
-        builder.add(types.InlineKeyboardButton(
-            text=option,
-            callback_data="right_answer" if option == right_answer else "wrong_answer")
-        )
-    builder.adjust(1)
-    return builder.as_markup()
-
-
-# pool добавлен как первый аргумент
-async def get_question(pool: ydb.SessionPool, message: types.Message, user_id):
+# Кэш состояний квиза в памяти инстанса.
+# QUIZ_STATE_FLUSH_EVERY=1 (по умолчанию) - запись в хранилище на каждое изменение. Облачная функция между вызовами
+# заморожена, и таймер сброса в ней не срабатывает: отложенная запись включается только в worker.py
+QUIZ_STATE_CACHE_SIZE = int(os.getenv("QUIZ_STATE_CACHE_SIZE", "10000"))
+QUIZ_STATE_CACHE_TTL = float(os.getenv("QUIZ_STATE_CACHE_TTL", "300"))
+QUIZ_STATE_FLUSH_EVERY = int(os.getenv("QUIZ_STATE_FLUSH_EVERY", "1"))
+QUIZ_STATE_FLUSH_INTERVAL = float(os.getenv("QUIZ_STATE_FLUSH_INTERVAL", "5"))
+# Режим на время (/timed): секунд на вопрос и запас на доставку ответа, после которого ответ не засчитывается
+QUIZ_TIME_LIMIT = int(os.getenv("QUIZ_TIME_LIMIT", "20"))
+QUIZ_TIME_GRACE_MS = int(float(os.getenv("QUIZ_TIME_GRACE", "1")) * 1000)
+
+state_cache = QuizStateCache(QUIZ_STATE_CACHE_SIZE, QUIZ_STATE_CACHE_TTL)
+_flush_task: asyncio.Task | None = None
+_background_tasks: set[asyncio.Task] = set()
+
+# store добавлен как первый аргумент
+async def get_question(store: QuizStateStore, message: types.Message, user_id):
     logger.debug(f"User {user_id}: Getting question.")
-    # Получение текущего вопроса из словаря состояний пользователя
-    current_question_index = await get_quiz_index(pool, user_id) # Передаем pool
+    # Получение текущего состояния пользователя (из кэша или хранилища)
+    entry = await load_state(store, user_id)
+    current_question_index = entry.question_index if entry is not None else None
     logger.debug(f"User {user_id}: Current question index: {current_question_index}")
 
-    # Улучшенная проверка на выход за пределы quiz_data
-    if current_question_index is None or current_question_index < 0 or current_question_index >= len(quiz_data):
+    if entry is None:
+        logger.info(f"User {user_id}: No quiz state found, starting from 0.")
+        entry = await reset_user_quiz_state(store, user_id)
+    # Проверка на выход за пределы квиза
+    elif current_question_index < 0 or current_question_index >= bank.quiz_length():
         logger.error(f"User {user_id}: Invalid question index {current_question_index} in get_question! Resetting state.")
-        await reset_user_quiz_state(pool, user_id) # Передаем pool
-        current_question_index = await get_quiz_index(pool, user_id) # Передаем pool
-        if current_question_index is None or current_question_index < 0 or current_question_index >= len(quiz_data):
-             logger.critical(f"User {user_id}: State reset failed or quiz_data is empty.")
+        entry = await reset_user_quiz_state(store, user_id)
+        if bank.quiz_length() == 0:
+             logger.critical(f"User {user_id}: State reset failed or question bank is empty.")
              await message.answer("Критическая ошибка при подготовке квиза :( Обратитесь к администратору.")
              return
 
-        # Если сброс помог и индекс стал валидным (обычно 0)
-        question: str = quiz_data[current_question_index]['question']
-        options: list[str] = quiz_data[current_question_index]['options']
-        correct_option_index: int = quiz_data[current_question_index]['correct_option']
-        kb = generate_options_keyboard(options, options[correct_option_index])
-        sent_message = await message.answer("Произошла ошибка с индексом вопроса, но состояние сброшено. Начнем заново.")
-        # Очищаем предыдущее сообщение перед отправкой первого вопроса после сброса
-        await message.bot.delete_message(chat_id=message.chat.id, message_id=sent_message.message_id) # Удаляем сообщение "Произошла ошибка..."
-        sent_message = await message.answer(question, reply_markup=kb)
-        await update_last_question_message_id(pool, user_id, sent_message.message_id) # Сохраняем message_id
+        # Сброс помог, индекс стал 0
+        notice = await message.answer("Произошла ошибка с индексом вопроса, но состояние сброшено. Начнем заново.")
+        # Удаление уведомления и отправка первого вопроса независимы
+        await asyncio.gather(
+            _delete_message_quietly(message, notice.message_id),
+            send_question(store, message, user_id, entry.question_index, entry.session_id),
+        )
         return
 
-    # Если индекс изначально валидный
-    question: str = quiz_data[current_question_index]['question']
-    options: list[str] = quiz_data[current_question_index]['options']
-    correct_option_index: int = quiz_data[current_question_index]['correct_option']
-    kb = generate_options_keyboard(options, options[correct_option_index])
+    if bank.quiz_length() == 0:
+        logger.critical(f"User {user_id}: Question bank is empty.")
+        await message.answer("Критическая ошибка при подготовке квиза :( Обратитесь к администратору.")
+        return
 
-    sent_message = await message.answer(question, reply_markup=kb)
-    await update_last_question_message_id(pool, user_id, sent_message.message_id) # Сохраняем message_id
-    logger.debug(f"User {user_id}: Sent question index {current_question_index}, message_id {sent_message.message_id}.")
+    # Если индекс валидный
+    await send_question(store, message, user_id, entry.question_index, entry.session_id)
 
 
-# pool добавлен как первый аргумент
-async def get_quiz_index(pool: ydb.SessionPool, user_id):
-    logger.debug(f"User {user_id}: Getting quiz index.")
-    query = """
-        DECLARE $user_id AS Uint64;
+async def _delete_message_quietly(message: types.Message, message_id: int):
+    try:
+        await message.bot.delete_message(chat_id=message.chat.id, message_id=message_id)
+    except Exception as e:
+        logger.warning(f"Failed to delete message {message_id} in chat {message.chat.id}: {e}")
 
-        SELECT question_index, last_question_message_id
-        FROM `quiz_state`
-        WHERE user_id == $user_id;
-    """
-    # Ключ в словаре БЕЗ символа $, _format_kwargs добавит $
-    params = {'user_id': user_id}
-    results = await execute_select_query(pool, query, **params)
-    logger.debug(f"User {user_id}: Quiz state query results: {results}")
-
-    if len(results) == 0:
-        logger.info(f"User {user_id}: No quiz state found, returning 0.")
-        # Если нет состояния, сбросим его и вернем 0
-        await reset_user_quiz_state(pool, user_id)
-        return 0
-    # Проверяем наличие ключа перед доступом
-    # results[0] - это словарь после преобразования в database.py
-    if "question_index" not in results[0] or results[0]["question_index"] is None:
-        logger.warning(f"User {user_id}: Quiz index is missing or None, returning 0.")
-        return 0
-
-    index = results[0]["question_index"]
-    logger.debug(f"User {user_id}: Found quiz index {index}.")
-    return index
-
-
-# pool добавлен как первый аргумент
-async def update_quiz_index(pool: ydb.SessionPool, user_id, question_index):
-    logger.debug(f"User {user_id}: Updating quiz index to {question_index}.")
-    query = """
-        DECLARE $user_id AS Uint64;
-        DECLARE $question_index AS Uint64;
-
-        UPSERT INTO `quiz_state` (`user_id`, `question_index`)
-        VALUES ($user_id, $question_index);
-    """
-    # Ключи в словаре БЕЗ символа $
-    params = {
-        'user_id': user_id,
-        'question_index': question_index,
-    }
-
-    await execute_update_query(
-        pool,
-        query,
-        **params
+
+# Отправляет вопрос по уже известным позиции и сессии, без повторного чтения quiz_state
+async def send_question(store: QuizStateStore, message: types.Message, user_id: int, question_index: int, session_id: int):
+    await send_question_to(store, message.bot, message.chat.id, user_id, question_index, session_id)
+
+
+async def send_question_to(store: QuizStateStore, bot: Bot, chat_id: int, user_id: int, question_index: int, session_id: int):
+    """Like send_question, but without an incoming message: used when a timed question expires."""
+    # Вопрос определяется позицией в перемешанной для этой сессии последовательности банка
+    payload = payload_at(session_id, question_index)
+    entry = state_cache.get(user_id)
+    text = payload.text
+    if entry is not None and entry.time_limit:
+        text = f"{text}\n\n⏱ На ответ {entry.time_limit} с."
+    sent_message = await bot.send_message(chat_id, text, reply_markup=payload.reply_markup)
+    await update_last_question_message_id(store, user_id, sent_message.message_id) # Сохраняем message_id
+    logger.debug(f"User {user_id}: Sent question {payload.question.id} at index {question_index}, message_id {sent_message.message_id}.")
+
+
+class QuizProgress(NamedTuple):
+    question_index: int  # индекс следующего вопроса (== длине квиза, если квиз завершен)
+    score: int
+    finished: bool
+    session_id: int  # seed последовательности вопросов этой сессии
+    quiz_length: int
+    timed_out: bool = False  # ответ пришел после лимита времени и не засчитан
+
+
+def _new_version() -> int:
+    # Случайная версия не требует чтения строки перед UPSERT
+    return random.getrandbits(63)
+
+
+def _new_session_id() -> int:
+    # Идентификатор прохождения квиза, он же seed порядка вопросов
+    return random.getrandbits(63)
+
+
+def _stored(entry: CachedQuizState, version: int) -> QuizState:
+    return QuizState(
+        entry.question_index, entry.score, entry.last_question_message_id, version, entry.session_id,
+        entry.time_limit, entry.question_sent_at,
     )
-    logger.debug(f"User {user_id}: Quiz index updated.")
 
-# Новая функция для обновления message_id
-async def update_last_question_message_id(pool: ydb.SessionPool, user_id: int, message_id: int):
-    logger.debug(f"User {user_id}: Updating last question message_id to {message_id}.")
-    query = """
-        DECLARE $user_id AS Uint64;
-        DECLARE $message_id AS Uint64; -- Telegram message_id может быть большим, используем Uint64
 
-        UPDATE `quiz_state`
-        SET last_question_message_id = $message_id
-        WHERE user_id == $user_id;
-    """
-    params = {
-        'user_id': user_id,
-        'message_id': message_id,
-    }
-    await execute_update_query(pool, query, **params)
-    logger.debug(f"User {user_id}: Last question message_id updated.")
+def _entry_from(state: QuizState) -> CachedQuizState:
+    return CachedQuizState(
+        state.question_index, state.score, state.last_question_message_id, state.version, state.session_id,
+        state.time_limit, state.question_sent_at,
+    )
+
+
+def _deadline(question_sent_at: int, time_limit: int) -> int | None:
+    # Срок ответа в мс с учетом запаса; None, если отсчет не идет
+    if not time_limit or not question_sent_at:
+        return None
+    return question_sent_at + time_limit * 1000 + QUIZ_TIME_GRACE_MS
+
+
+def _timed_out(question_sent_at: int, time_limit: int, now: int) -> bool:
+    deadline = _deadline(question_sent_at, time_limit)
+    return deadline is not None and now >= deadline
+
 
+def _cache_put(user_id: int, entry: CachedQuizState) -> None:
+    for evicted_id, evicted_entry in state_cache.put(user_id, entry):
+        # Вытесненные грязные записи сбрасываем в фоне
+        _spawn(_flush_evicted(evicted_id, evicted_entry))
 
-# pool добавлен как первый аргумент
-async def get_user_score(pool: ydb.SessionPool, user_id: int) -> int:
-    logger.debug(f"User {user_id}: Getting user score.")
-    query = """
-        DECLARE $user_id AS Uint64;
 
-        SELECT score, last_question_message_id
-        FROM `quiz_state`
-        WHERE user_id == $user_id;
+def _spawn(coro) -> None:
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _flush_evicted(user_id: int, entry: CachedQuizState) -> None:
+    store = await get_store()
+    if store is not None:
+        await _flush_entry(store, user_id, entry)
+
+
+def _ensure_flusher() -> None:
+    global _flush_task
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.get_running_loop().create_task(_flush_loop())
+
+
+async def _flush_loop() -> None:
+    # Периодический сброс грязных записей и вытеснение просроченных
+    while True:
+        await asyncio.sleep(QUIZ_STATE_FLUSH_INTERVAL)
+        try:
+            store = await get_store()
+            if store is not None:
+                await flush_all(store)
+            state_cache.evict_expired()
+        except Exception:
+            logger.error("Periodic quiz state flush failed.", exc_info=True)
+
+
+async def flush_all(store: QuizStateStore) -> None:
+    """Flushes every dirty cached state to the store (timer tick or graceful shutdown)."""
+    for user_id, entry in state_cache.dirty_items():
+        await _flush_entry(store, user_id, entry)
+
+
+async def _flush_entry(store: QuizStateStore, user_id: int, entry: CachedQuizState) -> bool:
     """
-    # Ключ в словаре БЕЗ символа $
-    params = {'user_id': user_id}
-    results = await execute_select_query(pool, query, **params)
-    logger.debug(f"User {user_id}: User score query results: {results}")
-
-    if results:
-        # results[0] - это словарь
-        score = results[0].get('score') # Используем .get() для безопасного доступа
-        logger.debug(f"User {user_id}: Found score {score}.")
-        return score or 0
-    else:
-        logger.info(f"User {user_id}: No quiz state found for score, resetting.")
-        await reset_user_quiz_state(pool, user_id)
-        return 0
-
-# pool добавлен как первый аргумент
-async def update_user_score(pool: ydb.SessionPool, user_id: int, score: int):
-    logger.debug(f"User {user_id}: Updating user score to {score}.")
-    query = """
-        DECLARE $user_id AS Uint64;
-        DECLARE $score AS Uint64;
-
-        UPDATE `quiz_state`
-        SET score = $score
-        WHERE user_id == $user_id;
+    Writes the cached state if the stored row still has the version we loaded.
+    Returns False on a version conflict: another instance changed the row, the local copy is dropped.
     """
-    params = {'user_id': user_id, 'score': score}
-    await execute_update_query(pool, query, **params)
-    logger.debug(f"User {user_id}: Score updated.")
+    async with entry.flush_lock:
+        if not entry.dirty:
+            return True
+        revision = entry.revision
+        answers = entry.pending_answers
+        new_version = _new_version()
+        try:
+            written = await store.save_if_version(user_id, _stored(entry, new_version), entry.version)
+        except Exception:
+            logger.error(f"User {user_id}: Quiz state flush failed.", exc_info=True)
+            raise
+        if not written:
+            logger.warning(f"User {user_id}: Quiz state was changed by another instance, dropping cached copy.")
+            state_cache.discard(user_id, entry)
+            return False
+
+        entry.version = new_version
+        entry.flushed_revision = revision
+        entry.pending_answers -= answers
+        logger.debug(f"User {user_id}: Quiz state flushed (revision {revision}).")
+        return True
+
+
+async def _commit(store: QuizStateStore, user_id: int, entry: CachedQuizState, answered: bool = False, force: bool = False) -> bool:
+    # Отмечаем изменение записи и решаем, пора ли сбрасывать ее в хранилище
+    entry.revision += 1
+    if answered:
+        entry.pending_answers += 1
+    state_cache.touch(user_id, entry)
+    if force or not state_cache.enabled or QUIZ_STATE_FLUSH_EVERY <= 1 or entry.pending_answers >= QUIZ_STATE_FLUSH_EVERY:
+        return await _flush_entry(store, user_id, entry)
+    _ensure_flusher()
+    return True
+
+
+async def load_state(store: QuizStateStore, user_id: int) -> CachedQuizState | None:
+    """Returns the user's state from the cache, or reads the full row from the store and caches it."""
+    entry = state_cache.get(user_id)
+    if entry is not None:
+        return entry
+    state = await store.load(user_id)
+    logger.debug(f"User {user_id}: Loaded quiz state: {state}")
+    if state is None:
+        return None
+    entry = _entry_from(state)
+    _cache_put(user_id, entry)
+    return entry
+
+
+async def load_states(store: QuizStateStore, user_ids: list[int]) -> dict[int, CachedQuizState]:
+    """Like load_state for many users: cache misses are read with one query. Users without state are absent."""
+    entries = {}
+    missing = []
+    for user_id in user_ids:
+        entry = state_cache.get(user_id)
+        if entry is not None:
+            entries[user_id] = entry
+        else:
+            missing.append(user_id)
+    if missing:
+        for user_id, state in (await store.load_many(missing)).items():
+            entry = _entry_from(state)
+            _cache_put(user_id, entry)
+            entries[user_id] = entry
+    return entries
+
+
+class StaleAnswerError(Exception):
+    """The answered question is not the user's current question (old button or repeated tap)."""
+
+
+def _is_stale(session_id: int | None, question_index: int | None, current_session_id: int, current_index: int) -> bool:
+    if session_id is None or question_index is None:
+        return False
+    return session_id != current_session_id or question_index != current_index
+
+
+def _behind_unflushed(entry: CachedQuizState, session_id: int | None, question_index: int | None) -> bool:
+    # Запись с несброшенными изменениями новее хранилища: другой инстанс не мог продвинуть строку дальше
+    # без конфликта версий. Только для нее нажатие позади кэша - точно устаревшее
+    return (
+        entry.dirty and session_id == entry.session_id
+        and question_index is not None and question_index < entry.question_index
+    )
 
-# pool добавлен как первый аргумент
-async def reset_user_quiz_state(pool: ydb.SessionPool, user_id: int):
-    logger.info(f"User {user_id}: Resetting quiz state.")
-    query = """
-        DECLARE $user_id AS Uint64;
 
-        UPSERT INTO `quiz_state` (user_id, question_index, score, last_question_message_id)
-        VALUES ($user_id, 0, 0, 0);
+def is_stale_answer(user_id: int, session_id: int, question_index: int) -> bool:
+    """
+    True only if the cached state alone proves the answer stale; otherwise the store decides in advance_quiz.
+    Чистая запись кэша могла отстать от хранилища, если квиз продвинул другой инстанс.
     """
-    params = {'user_id': user_id}
-    await execute_update_query(pool, query, **params)
+    entry = state_cache.get(user_id)
+    return entry is not None and _behind_unflushed(entry, session_id, question_index)
+
+
+async def advance_quiz(
+    store: QuizStateStore,
+    user_id: int,
+    answered_correctly: bool,
+    session_id: int | None = None,
+    question_index: int | None = None,
+    expired: bool = False,
+) -> QuizProgress | None:
+    """
+    Moves the user to the next question and returns the new progress.
+    Returns None if the stored state was invalid and has been reset.
+    If session_id/question_index of the answered question are given and do not match
+    the current state, raises StaleAnswerError without changing anything.
+    An answer after the time limit of a timed quiz scores zero (progress.timed_out).
+    expired=True moves on without an answer and raises StaleAnswerError unless the deadline has really passed.
+    При наличии состояния в кэше ответ обрабатывается в памяти, иначе - одной транзакцией в хранилище.
+    """
+    logger.debug(f"User {user_id}: Advancing quiz (correct={answered_correctly}, expired={expired}).")
+    entry = state_cache.get(user_id)
+    if entry is None:
+        return await _advance_in_transaction(store, user_id, answered_correctly, session_id, question_index, expired)
+
+    if _is_stale(session_id, question_index, entry.session_id, entry.question_index):
+        if _behind_unflushed(entry, session_id, question_index):
+            raise StaleAnswerError()
+        # Кэш мог отстать: строку продвинул другой инстанс. Несброшенные изменения пишем с проверкой версии
+        # (при конфликте копия отбрасывается), дальше решает транзакция по актуальной строке
+        if entry.dirty:
+            await _flush_entry(store, user_id, entry)
+        state_cache.discard(user_id, entry)
+        return await _advance_in_transaction(store, user_id, answered_correctly, session_id, question_index, expired)
+    timed_out = _timed_out(entry.question_sent_at, entry.time_limit, now_ms())
+    if expired and not timed_out:
+        raise StaleAnswerError()
+    answered_correctly = answered_correctly and not timed_out
+    scheduler.cancel(user_id)
+
+    quiz_length = bank.quiz_length()
+    if entry.question_index >= quiz_length:
+        await reset_user_quiz_state(store, user_id)
+        return None
+
+    current_session_id = entry.session_id
+    new_index = entry.question_index + 1
+    new_score = entry.score + (1 if answered_correctly else 0)
+    finished = new_index >= quiz_length
+    if finished:
+        # По завершении квиза состояние обнуляется и сразу пишется в хранилище.
+        # Новая сессия делает все кнопки завершенного квиза устаревшими
+        entry.question_index, entry.score, entry.last_question_message_id = 0, 0, 0
+        entry.session_id = _new_session_id()
+        entry.time_limit = 0
+    else:
+        entry.question_index, entry.score = new_index, new_score
+    entry.question_sent_at = 0
+
+    if not await _commit(store, user_id, entry, answered=True, force=finished):
+        # Конфликт версий: строку изменил другой инстанс, применяем ответ к актуальному состоянию
+        return await _advance_in_transaction(store, user_id, answered_correctly, session_id, question_index, expired)
+    progress = QuizProgress(new_index, new_score, finished, current_session_id, quiz_length, timed_out)
+    logger.debug(f"User {user_id}: Quiz advanced in cache: {progress}")
+    return progress
+
+
+async def _advance_in_transaction(
+    store: QuizStateStore,
+    user_id: int,
+    answered_correctly: bool,
+    expected_session_id: int | None = None,
+    expected_index: int | None = None,
+    expired: bool = False,
+) -> QuizProgress | None:
+    # Чтение, проверка и запись quiz_state атомарно на стороне хранилища
+    new_version = _new_version()
+    quiz_length = bank.quiz_length()
+    now = now_ms()
+    scheduler.cancel(user_id)
+
+    def mutate(current: QuizState | None):
+        if current is not None and _is_stale(expected_session_id, expected_index, current.session_id, current.question_index):
+            return (None, None), None
+        timed_out = current is not None and _timed_out(current.question_sent_at, current.time_limit, now)
+        if expired and not timed_out:
+            return (None, None), None
+
+        if current is None or current.question_index >= quiz_length:
+            state = QuizState(0, 0, 0, new_version, _new_session_id())
+            return (None, state), state
+
+        new_index = current.question_index + 1
+        new_score = current.score + (1 if answered_correctly and not timed_out else 0)
+        finished = new_index >= quiz_length
+        if finished:
+            state = QuizState(0, 0, 0, new_version, _new_session_id())
+        else:
+            state = QuizState(new_index, new_score, current.last_question_message_id, new_version, current.session_id, current.time_limit)
+        return (QuizProgress(new_index, new_score, finished, current.session_id, quiz_length, timed_out), state), state
+
+    try:
+        progress, state = await store.transact(user_id, mutate, name="advance_quiz")
+    except Exception:
+        logger.error(f"User {user_id}: Advance quiz transaction failed.", exc_info=True)
+        raise
+    if state is None:
+        raise StaleAnswerError()
+    _cache_put(user_id, _entry_from(state))
+    logger.debug(f"User {user_id}: Quiz advanced: {progress}")
+    return progress
+
+
+# Новая функция для обновления message_id
+async def update_last_question_message_id(store: QuizStateStore, user_id: int, message_id: int):
+    logger.debug(f"User {user_id}: Updating last question message_id to {message_id}.")
+    entry = await load_state(store, user_id)
+    if entry is None:
+        logger.info(f"User {user_id}: No quiz state found, message_id not saved.")
+        return
+    entry.last_question_message_id = message_id
+    if entry.time_limit:
+        # Отсчет идет с момента отправки вопроса. Запись сразу, чтобы обход истекших вопросов увидел его
+        # и из другого инстанса
+        entry.question_sent_at = now_ms()
+        scheduler.schedule(user_id, entry.session_id, entry.question_index, _deadline(entry.question_sent_at, entry.time_limit))
+    await _commit(store, user_id, entry, force=bool(entry.time_limit))
+    logger.debug(f"User {user_id}: Last question message_id updated.")
+
+
+# store добавлен как первый аргумент
+async def reset_user_quiz_state(store: QuizStateStore, user_id: int, time_limit: int = 0) -> CachedQuizState:
+    logger.info(f"User {user_id}: Resetting quiz state.")
+    # Сброс пишется в хранилище сразу и без проверки версии: новый квиз перекрывает любое прежнее состояние
+    # Каждый сброс начинает новую сессию с новым порядком вопросов
+    # time_limit > 0 начинает квиз на время с этим лимитом на вопрос
+    scheduler.cancel(user_id)
+    version = _new_version()
+    entry = CachedQuizState(0, 0, 0, version, _new_session_id(), time_limit)
+    await store.save(user_id, _stored(entry, version))
+    _cache_put(user_id, entry)
     logger.info(f"User {user_id}: Quiz state reset.")
+    return entry
 
 # Новая функция для получения message_id
-async def get_last_question_message_id(pool: ydb.SessionPool, user_id: int) -> int | None:
+async def get_last_question_message_id(store: QuizStateStore, user_id: int) -> int | None:
     logger.debug(f"User {user_id}: Getting last question message_id.")
-    query = """
-        DECLARE $user_id AS Uint64;
+    entry = await load_state(store, user_id)
 
-        SELECT last_question_message_id
-        FROM `quiz_state`
-        WHERE user_id == $user_id;
-    """
-    params = {'user_id': user_id}
-    results = await execute_select_query(pool, query, **params)
-    logger.debug(f"User {user_id}: Last message_id query results: {results}")
-
-    # results - это список словарей после преобразования в database.py
-    if results and results[0].get('last_question_message_id') is not None:
-        message_id = results[0]['last_question_message_id']
-        logger.debug(f"User {user_id}: Found last message_id {message_id}.")
-        return message_id
+    if entry is not None:
+        logger.debug(f"User {user_id}: Found last message_id {entry.last_question_message_id}.")
+        return entry.last_question_message_id
     else:
         logger.info(f"User {user_id}: No last message_id found, returning None.")
         return None
@@ -0,0 +1,118 @@
+import time
+import asyncio
+from collections import OrderedDict
+
+
+class CachedQuizState:
+    """
+    In-memory copy of one quiz_state row.
+    version - версия строки в YDB, с которой синхронизирована запись (для оптимистичной проверки при сбросе).
+    """
+    __slots__ = (
+        'question_index', 'score', 'last_question_message_id', 'version', 'session_id',
+        'time_limit', 'question_sent_at', 'revision', 'flushed_revision', 'pending_answers', 'expires_at', 'flush_lock',
+    )
+
+    def __init__(
+        self,
+        question_index: int,
+        score: int,
+        last_question_message_id: int,
+        version: int | None,
+        session_id: int = 0,
+        time_limit: int = 0,
+        question_sent_at: int = 0,
+    ):
+        self.question_index = question_index
+        self.score = score
+        self.last_question_message_id = last_question_message_id
+        self.version = version
+        # session_id - идентификатор текущего прохождения и seed порядка вопросов
+        self.session_id = session_id
+        # Режим на время: лимит на вопрос в секундах и время отправки вопроса в мс (0 - отсчет не идет)
+        self.time_limit = time_limit
+        self.question_sent_at = question_sent_at
+        # revision растет при каждом изменении в памяти, flushed_revision - последняя записанная в YDB
+        self.revision = 0
+        self.flushed_revision = 0
+        self.pending_answers = 0
+        self.expires_at = 0.0
+        self.flush_lock = asyncio.Lock()
+
+    @property
+    def dirty(self) -> bool:
+        return self.revision != self.flushed_revision
+
+
+class QuizStateCache:
+    """
+    Per-user quiz_state cache with a size limit, TTL and LRU eviction.
+    Грязные записи не теряются: при вытеснении они возвращаются вызывающему коду для сброса в YDB.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict[int, CachedQuizState] = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get(self, user_id: int) -> CachedQuizState | None:
+        entry = self._items.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires_at < time.monotonic() and not entry.dirty:
+            # Чистую просроченную запись просто выбрасываем, она будет перечитана из YDB
+            del self._items[user_id]
+            self.misses += 1
+            return None
+        self._items.move_to_end(user_id)
+        self.hits += 1
+        return entry
+
+    def put(self, user_id: int, entry: CachedQuizState) -> list[tuple[int, CachedQuizState]]:
+        """Stores the entry and returns evicted dirty entries that still have to be flushed."""
+        if not self.enabled:
+            return []
+        entry.expires_at = time.monotonic() + self.ttl
+        self._items[user_id] = entry
+        self._items.move_to_end(user_id)
+        evicted = []
+        while len(self._items) > self.max_size:
+            evicted_id, evicted_entry = self._items.popitem(last=False)
+            if evicted_entry.dirty:
+                evicted.append((evicted_id, evicted_entry))
+        return evicted
+
+    def touch(self, user_id: int, entry: CachedQuizState) -> None:
+        # Продлеваем TTL после изменения
+        if self._items.get(user_id) is entry:
+            entry.expires_at = time.monotonic() + self.ttl
+
+    def discard(self, user_id: int, entry: CachedQuizState | None = None) -> None:
+        # Удаляем запись, только если в кэше лежит именно она (или entry не указан)
+        if entry is None or self._items.get(user_id) is entry:
+            self._items.pop(user_id, None)
+
+    def dirty_items(self) -> list[tuple[int, CachedQuizState]]:
+        return [(user_id, entry) for user_id, entry in self._items.items() if entry.dirty]
+
+    def evict_expired(self) -> None:
+        now = time.monotonic()
+        expired = [user_id for user_id, entry in self._items.items() if entry.expires_at < now and not entry.dirty]
+        for user_id in expired:
+            del self._items[user_id]
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._items),
+            'dirty': sum(1 for entry in self._items.values() if entry.dirty),
+            'max_size': self.max_size,
+        }
@@ -0,0 +1,549 @@
+import os
+import time
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Any, Callable, NamedTuple
+import ydb
+import ydb.aio
+import database
+from database import WriteBatcher, execute_select_records, execute_transaction, prepare, query_cache
+
+if TYPE_CHECKING:
+    # sqlite3 нужен только бэкенду sqlite и импортируется при первом подключении
+    import sqlite3
+
+logger = logging.getLogger(__name__)
+
+# Где хранится quiz_state: ydb, memory (один процесс, без персистентности) или sqlite (локальный файл)
+QUIZ_STATE_BACKEND = os.getenv("QUIZ_STATE_BACKEND", "ydb")
+QUIZ_STATE_SQLITE_PATH = os.getenv("QUIZ_STATE_SQLITE_PATH", "quiz_state.sqlite3")
+# Через сколько дней без записей состояние считается брошенным (в YDB то же значение задает TTL, см. migrations.py)
+QUIZ_STATE_MAX_AGE_DAYS = float(os.getenv("QUIZ_STATE_MAX_AGE_DAYS", "30"))
+# Фоновая очистка: строк за один запрос, пауза между запросами и предел запросов за проход
+QUIZ_STATE_CLEANUP_BATCH = int(os.getenv("QUIZ_STATE_CLEANUP_BATCH", "500"))
+QUIZ_STATE_CLEANUP_PAUSE = float(os.getenv("QUIZ_STATE_CLEANUP_PAUSE", "0.5"))
+QUIZ_STATE_CLEANUP_MAX_BATCHES = int(os.getenv("QUIZ_STATE_CLEANUP_MAX_BATCHES", "100"))
+
+
+class QuizState(NamedTuple):
+    """
+    Typed quiz_state row as the store reads and writes it.
+    Кортеж без __dict__: строки результата YDB отображаются в него напрямую, без промежуточного словаря.
+    """
+    question_index: int
+    score: int
+    last_question_message_id: int
+    version: int | None
+    session_id: int
+    # Режим на время: лимит на вопрос в секундах (0 - без таймера) и время отправки текущего вопроса в мс UTC.
+    # question_sent_at обнуляется после ответа, поэтому ненулевое значение - идущий отсчет
+    time_limit: int = 0
+    question_sent_at: int = 0
+
+
+# mutate(текущее состояние или None) -> (результат, новое состояние или None, если писать нечего)
+Mutation = Callable[[QuizState | None], tuple[Any, QuizState | None]]
+
+
+class QuizStateStore(ABC):
+    """
+    Storage backend for quiz_state rows, keyed by user_id.
+    Сервисный слой работает только через этот интерфейс и не знает про YQL и пулы сессий.
+    """
+
+    def start(self) -> None:
+        """Starts connecting in the background, if the backend needs a connection."""
+
+    async def ready(self) -> bool:
+        """Returns False if the backend is currently unavailable."""
+        return True
+
+    async def close(self) -> None:
+        pass
+
+    async def load(self, user_id: int) -> QuizState | None:
+        return (await self.load_many([user_id])).get(user_id)
+
+    @abstractmethod
+    async def load_many(self, user_ids: list[int]) -> dict[int, QuizState]:
+        """Reads the full rows of many users in one query; users without a row are absent from the result."""
+
+    @abstractmethod
+    async def save(self, user_id: int, state: QuizState) -> None:
+        """Unconditionally writes the row."""
+
+    @abstractmethod
+    async def save_if_version(self, user_id: int, state: QuizState, expected_version: int | None) -> bool:
+        """Writes the row if it is missing or still has expected_version; returns False on a conflict."""
+
+    @abstractmethod
+    async def transact(self, user_id: int, mutate: Mutation, name: str = "transact_state") -> Any:
+        """
+        Reads the row, applies mutate and writes the new state atomically; returns mutate's result.
+        mutate - синхронная функция без побочных эффектов, бэкенд может вызвать ее повторно при ретрае.
+        """
+
+    @abstractmethod
+    async def expired(self, now_ms: int, limit: int) -> dict[int, QuizState]:
+        """Returns up to limit states whose timed question was sent more than time_limit before now_ms."""
+
+    @abstractmethod
+    async def delete_stale(self, updated_before: float, limit: int) -> int:
+        """
+        Handles up to limit abandoned rows: deletes those last written before updated_before (unix time in seconds)
+        and stamps rows written before updated_at existed with the current time, so they age out like the rest.
+        Returns the number of rows handled.
+        """
+
+
+_LOAD_STATE_QUERY = """
+    DECLARE $user_id AS Uint64;
+
+    SELECT question_index, score, last_question_message_id, version, session_id, time_limit, question_sent_at
+    FROM `quiz_state`
+    WHERE user_id == $user_id;
+"""
+
+_LOAD_STATES_QUERY = """
+    DECLARE $user_ids AS List<Uint64>;
+
+    SELECT user_id, question_index, score, last_question_message_id, version, session_id, time_limit, question_sent_at
+    FROM `quiz_state`
+    WHERE user_id IN $user_ids;
+"""
+
+# Идущие отсчеты читаются по индексу question_sent_at: ответившие пользователи в него не попадают
+_EXPIRED_STATES_QUERY = """
+    DECLARE $now AS Uint64;
+    DECLARE $limit AS Uint64;
+
+    SELECT user_id, question_index, score, last_question_message_id, version, session_id, time_limit, question_sent_at
+    FROM `quiz_state` VIEW `idx_question_sent_at`
+    WHERE question_sent_at > 0 AND question_sent_at <= $now
+        AND question_sent_at + CAST(time_limit AS Uint64) * 1000 <= $now
+    LIMIT $limit;
+"""
+
+_STATE_ROW_TYPE = """Struct<
+        user_id: Uint64,
+        question_index: Uint64,
+        score: Uint64,
+        last_question_message_id: Uint64,
+        version: Uint64,
+        session_id: Uint64,
+        time_limit: Uint32,
+        question_sent_at: Uint64,
+        expected_version: Uint64?
+    >"""
+
+# Безусловная запись пачки строк одним запросом
+_BATCH_SAVE_QUERY = f"""
+    DECLARE $rows AS List<{_STATE_ROW_TYPE}>;
+
+    UPSERT INTO `quiz_state`
+    SELECT user_id, question_index, score, last_question_message_id, version, session_id, time_limit, question_sent_at,
+        CurrentUtcTimestamp() AS updated_at
+    FROM AS_TABLE($rows);
+"""
+
+# Запись пачки с проверкой версий: строки, которые успел изменить другой инстанс, не пишутся и возвращаются
+_BATCH_SAVE_IF_VERSION_QUERY = f"""
+    DECLARE $rows AS List<{_STATE_ROW_TYPE}>;
+
+    $conflicts = (
+        SELECT r.user_id AS user_id
+        FROM AS_TABLE($rows) AS r
+        INNER JOIN `quiz_state` AS s ON s.user_id = r.user_id
+        WHERE s.version IS DISTINCT FROM r.expected_version
+    );
+
+    SELECT user_id FROM $conflicts;
+
+    UPSERT INTO `quiz_state`
+    SELECT
+        r.user_id AS user_id,
+        r.question_index AS question_index,
+        r.score AS score,
+        r.last_question_message_id AS last_question_message_id,
+        r.version AS version,
+        r.session_id AS session_id,
+        r.time_limit AS time_limit,
+        r.question_sent_at AS question_sent_at,
+        CurrentUtcTimestamp() AS updated_at
+    FROM AS_TABLE($rows) AS r
+    LEFT ONLY JOIN $conflicts AS c ON c.user_id = r.user_id;
+"""
+
+_SAVE_STATE_QUERY = """
+    DECLARE $user_id AS Uint64;
+    DECLARE $question_index AS Uint64;
+    DECLARE $score AS Uint64;
+    DECLARE $message_id AS Uint64;
+    DECLARE $version AS Uint64;
+    DECLARE $session_id AS Uint64;
+    DECLARE $time_limit AS Uint32;
+    DECLARE $question_sent_at AS Uint64;
+
+    UPSERT INTO `quiz_state` (user_id, question_index, score, last_question_message_id, version, session_id, time_limit, question_sent_at, updated_at)
+    VALUES ($user_id, $question_index, $score, $message_id, $version, $session_id, $time_limit, $question_sent_at, CurrentUtcTimestamp());
+"""
+
+
+def _state_from_row(row) -> QuizState:
+    return QuizState(
+        row['question_index'] or 0,
+        row['score'] or 0,
+        row['last_question_message_id'] or 0,
+        row['version'],
+        row['session_id'] or 0,
+        row['time_limit'] or 0,
+        row['question_sent_at'] or 0,
+    )
+
+
+def _keyed_state_from_row(row) -> tuple[int, QuizState]:
+    return row['user_id'], _state_from_row(row)
+
+
+def _state_row(user_id: int, state: QuizState, expected_version: int | None = None) -> dict:
+    return {'user_id': user_id, **state._asdict(), 'expected_version': expected_version}
+
+
+def _state_params(user_id: int, state: QuizState) -> dict:
+    return {
+        '$user_id': user_id,
+        '$question_index': state.question_index,
+        '$score': state.score,
+        '$message_id': state.last_question_message_id,
+        '$version': state.version,
+        '$session_id': state.session_id,
+        '$time_limit': state.time_limit,
+        '$question_sent_at': state.question_sent_at,
+    }
+
+
+class YdbQuizStateStore(QuizStateStore):
+    """
+    quiz_state in YDB through the shared database.connection pool.
+    Записи разных пользователей копятся несколько миллисекунд и уходят одним запросом (database.WriteBatcher).
+    """
+
+    def __init__(self):
+        self._save_batcher = WriteBatcher(_BATCH_SAVE_QUERY, 'user_id', "save_state")
+        self._flush_batcher = WriteBatcher(_BATCH_SAVE_IF_VERSION_QUERY, 'user_id', "flush_state")
+
+    def batch_stats(self) -> dict:
+        return {'save': self._save_batcher.stats(), 'flush': self._flush_batcher.stats()}
+
+    def start(self) -> None:
+        database.connection.start()
+
+    async def ready(self) -> bool:
+        return await database.get_pool() is not None
+
+    async def _pool(self) -> ydb.aio.SessionPool:
+        pool = await database.get_pool()
+        if pool is None:
+            raise ConnectionError("YDB pool is unavailable")
+        return pool
+
+    async def load(self, user_id: int) -> QuizState | None:
+        records = await execute_select_records(await self._pool(), _LOAD_STATE_QUERY, _state_from_row, query_name="load_state", user_id=user_id)
+        return records[0] if records else None
+
+    async def load_many(self, user_ids: list[int]) -> dict[int, QuizState]:
+        if not user_ids:
+            return {}
+        records = await execute_select_records(
+            await self._pool(), _LOAD_STATES_QUERY, _keyed_state_from_row, query_name="load_states", user_ids=list(user_ids),
+        )
+        return dict(records)
+
+    async def save(self, user_id: int, state: QuizState) -> None:
+        await self._save_batcher.write(_state_row(user_id, state))
+
+    async def save_if_version(self, user_id: int, state: QuizState, expected_version: int | None) -> bool:
+        return await self._flush_batcher.write(_state_row(user_id, state, expected_version))
+
+    async def transact(self, user_id: int, mutate: Mutation, name: str = "transact_state") -> Any:
+        # Чтение, проверка и запись quiz_state в одной SerializableReadWrite транзакции
+        async def callee(session: ydb.aio.table.Session):
+            tx_context = session.transaction(ydb.SerializableReadWrite())
+            try:
+                result_sets = await tx_context.execute(await prepare(session, _LOAD_STATE_QUERY), {'$user_id': user_id})
+                rows = result_sets[0].rows if result_sets else []
+                result, new_state = mutate(_state_from_row(rows[0]) if rows else None)
+                if new_state is None:
+                    await tx_context.rollback()
+                    return result
+                await tx_context.execute(await prepare(session, _SAVE_STATE_QUERY), _state_params(user_id, new_state), commit_tx=True)
+                return result
+            except Exception:
+                for query in (_LOAD_STATE_QUERY, _SAVE_STATE_QUERY):
+                    query_cache.discard(session, query)
+                await tx_context.rollback()
+                raise
+
+        return await execute_transaction(await self._pool(), callee, query_name=name)
+
+    async def expired(self, now_ms: int, limit: int) -> dict[int, QuizState]:
+        records = await execute_select_records(
+            await self._pool(), _EXPIRED_STATES_QUERY, _keyed_state_from_row, query_name="expired_states", now=now_ms, limit=limit,
+        )
+        return dict(records)
+
+    async def delete_stale(self, updated_before: float, limit: int) -> int:
+        # Брошенные строки удаляет сам YDB по TTL на updated_at (миграция 8), строки без updated_at она же заполнила.
+        # Ручной обход читал бы всю таблицу: на updated_at нет индекса
+        return 0
+
+
+class MemoryQuizStateStore(QuizStateStore):
+    """
+    quiz_state in a dict of this process: for a single worker, local runs and benchmarks.
+    Между await-точками операций нет, поэтому каждая из них атомарна без блокировок.
+    """
+
+    def __init__(self):
+        self._rows: dict[int, QuizState] = {}
+        self._updated_at: dict[int, float] = {}
+
+    def _put(self, user_id: int, state: QuizState) -> None:
+        self._rows[user_id] = state
+        self._updated_at[user_id] = time.time()
+
+    async def load(self, user_id: int) -> QuizState | None:
+        return self._rows.get(user_id)
+
+    async def load_many(self, user_ids: list[int]) -> dict[int, QuizState]:
+        return {user_id: self._rows[user_id] for user_id in user_ids if user_id in self._rows}
+
+    async def save(self, user_id: int, state: QuizState) -> None:
+        self._put(user_id, state)
+
+    async def save_if_version(self, user_id: int, state: QuizState, expected_version: int | None) -> bool:
+        current = self._rows.get(user_id)
+        if current is not None and current.version != expected_version:
+            return False
+        self._put(user_id, state)
+        return True
+
+    async def transact(self, user_id: int, mutate: Mutation, name: str = "transact_state") -> Any:
+        result, new_state = mutate(self._rows.get(user_id))
+        if new_state is not None:
+            self._put(user_id, new_state)
+        return result
+
+    async def expired(self, now_ms: int, limit: int) -> dict[int, QuizState]:
+        expired = {}
+        for user_id, state in self._rows.items():
+            if state.question_sent_at and state.question_sent_at + state.time_limit * 1000 <= now_ms:
+                expired[user_id] = state
+                if len(expired) >= limit:
+                    break
+        return expired
+
+    async def delete_stale(self, updated_before: float, limit: int) -> int:
+        stale = [user_id for user_id, updated_at in self._updated_at.items() if updated_at < updated_before][:limit]
+        for user_id in stale:
+            del self._rows[user_id]
+            del self._updated_at[user_id]
+        return len(stale)
+
+
+_SQLITE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS quiz_state (
+        user_id INTEGER PRIMARY KEY,
+        question_index INTEGER,
+        score INTEGER,
+        last_question_message_id INTEGER,
+        version INTEGER,
+        session_id INTEGER,
+        time_limit INTEGER DEFAULT 0,
+        question_sent_at INTEGER DEFAULT 0,
+        updated_at INTEGER
+    )
+"""
+
+# Колонки, добавленные после первой версии схемы: в существующий файл дописываются при подключении
+_SQLITE_ADDED_COLUMNS = {
+    'time_limit': "INTEGER DEFAULT 0",
+    'question_sent_at': "INTEGER DEFAULT 0",
+    'updated_at': "INTEGER",
+}
+
+_SQLITE_COLUMNS = "question_index, score, last_question_message_id, version, session_id, time_limit, question_sent_at"
+
+_SQLITE_SAVE = f"""
+    INSERT OR REPLACE INTO quiz_state (user_id, {_SQLITE_COLUMNS}, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+class SqliteQuizStateStore(QuizStateStore):
+    """
+    quiz_state in a local SQLite file: persistent single-host deployments without a cloud database.
+    Запросы выполняются в отдельном потоке по одному, BEGIN IMMEDIATE защищает от других процессов.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection: "sqlite3.Connection | None" = None
+        self._lock = asyncio.Lock()
+
+    def _connect(self) -> "sqlite3.Connection":
+        if self._connection is None:
+            import sqlite3
+            # isolation_level=None: транзакции открываем явно
+            connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(_SQLITE_SCHEMA)
+            existing = {row['name'] for row in connection.execute("PRAGMA table_info(quiz_state)")}
+            for column, definition in _SQLITE_ADDED_COLUMNS.items():
+                if column not in existing:
+                    connection.execute(f"ALTER TABLE quiz_state ADD COLUMN {column} {definition}")
+            connection.execute("CREATE INDEX IF NOT EXISTS idx_question_sent_at ON quiz_state (question_sent_at)")
+            self._connection = connection
+        return self._connection
+
+    async def _run(self, fn: Callable[["sqlite3.Connection"], Any]) -> Any:
+        async with self._lock:
+            return await asyncio.to_thread(lambda: fn(self._connect()))
+
+    @staticmethod
+    def _select(connection: "sqlite3.Connection", user_id: int) -> QuizState | None:
+        row = connection.execute(
+            f"SELECT {_SQLITE_COLUMNS} FROM quiz_state WHERE user_id = ?",
+            (user_id,),
+        ).fetchone()
+        return _state_from_row(row) if row is not None else None
+
+    @staticmethod
+    def _write(connection: "sqlite3.Connection", user_id: int, state: QuizState) -> None:
+        # updated_at в мс UTC, как question_sent_at
+        connection.execute(_SQLITE_SAVE, (user_id, *state, int(time.time() * 1000)))
+
+    @staticmethod
+    def _in_transaction(connection: "sqlite3.Connection", fn: Callable[[], Any]) -> Any:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn()
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return result
+
+    async def load(self, user_id: int) -> QuizState | None:
+        return await self._run(lambda connection: self._select(connection, user_id))
+
+    async def load_many(self, user_ids: list[int]) -> dict[int, QuizState]:
+        if not user_ids:
+            return {}
+
+        def select_many(connection: "sqlite3.Connection") -> dict[int, QuizState]:
+            placeholders = ", ".join("?" * len(user_ids))
+            rows = connection.execute(
+                f"SELECT user_id, {_SQLITE_COLUMNS} FROM quiz_state WHERE user_id IN ({placeholders})",
+                list(user_ids),
+            ).fetchall()
+            return dict(_keyed_state_from_row(row) for row in rows)
+
+        return await self._run(select_many)
+
+    async def save(self, user_id: int, state: QuizState) -> None:
+        await self._run(lambda connection: self._write(connection, user_id, state))
+
+    async def save_if_version(self, user_id: int, state: QuizState, expected_version: int | None) -> bool:
+        def run(connection: "sqlite3.Connection") -> bool:
+            def check_and_write() -> bool:
+                current = self._select(connection, user_id)
+                if current is not None and current.version != expected_version:
+                    return False
+                self._write(connection, user_id, state)
+                return True
+            return self._in_transaction(connection, check_and_write)
+
+        return await self._run(run)
+
+    async def transact(self, user_id: int, mutate: Mutation, name: str = "transact_state") -> Any:
+        def run(connection: "sqlite3.Connection") -> Any:
+            def apply() -> Any:
+                result, new_state = mutate(self._select(connection, user_id))
+                if new_state is not None:
+                    self._write(connection, user_id, new_state)
+                return result
+            return self._in_transaction(connection, apply)
+
+        return await self._run(run)
+
+    async def expired(self, now_ms: int, limit: int) -> dict[int, QuizState]:
+        def select_expired(connection: "sqlite3.Connection") -> dict[int, QuizState]:
+            rows = connection.execute(
+                f"SELECT user_id, {_SQLITE_COLUMNS} FROM quiz_state"
+                " WHERE question_sent_at > 0 AND question_sent_at + time_limit * 1000 <= ? LIMIT ?",
+                (now_ms, limit),
+            ).fetchall()
+            return dict(_keyed_state_from_row(row) for row in rows)
+
+        return await self._run(select_expired)
+
+    async def delete_stale(self, updated_before: float, limit: int) -> int:
+        def delete(connection: "sqlite3.Connection") -> int:
+            deleted = connection.execute(
+                "DELETE FROM quiz_state WHERE user_id IN ("
+                "SELECT user_id FROM quiz_state WHERE updated_at < ? LIMIT ?)",
+                (int(updated_before * 1000), limit),
+            ).rowcount
+            stamped = connection.execute(
+                "UPDATE quiz_state SET updated_at = ? WHERE user_id IN ("
+                "SELECT user_id FROM quiz_state WHERE updated_at IS NULL LIMIT ?)",
+                (int(time.time() * 1000), limit - deleted),
+            ).rowcount
+            return deleted + stamped
+
+        return await self._run(delete)
+
+    async def close(self) -> None:
+        async with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def create_store(backend: str = QUIZ_STATE_BACKEND) -> QuizStateStore:
+    if backend == "ydb":
+        return YdbQuizStateStore()
+    if backend == "memory":
+        return MemoryQuizStateStore()
+    if backend == "sqlite":
+        return SqliteQuizStateStore(QUIZ_STATE_SQLITE_PATH)
+    raise ValueError(f"Unknown QUIZ_STATE_BACKEND: {backend!r}")
+
+
+store = create_store()
+
+
+async def get_store() -> QuizStateStore | None:
+    """Returns the configured store, or None if its backend is unavailable right now."""
+    return store if await store.ready() else None
+
+
+async def cleanup_stale(store: QuizStateStore, max_age_days: float = QUIZ_STATE_MAX_AGE_DAYS) -> int:
+    """
+    Deletes abandoned quiz states in bounded chunks with a pause between them, so live traffic keeps priority.
+    Returns the number of deleted rows.
+    """
+    updated_before = time.time() - max_age_days * 86400
+    deleted = 0
+    for _ in range(QUIZ_STATE_CLEANUP_MAX_BATCHES):
+        count = await store.delete_stale(updated_before, QUIZ_STATE_CLEANUP_BATCH)
+        deleted += count
+        if count < QUIZ_STATE_CLEANUP_BATCH:
+            break
+        await asyncio.sleep(QUIZ_STATE_CLEANUP_PAUSE)
+    if deleted:
+        logger.info(f"Quiz state cleanup deleted {deleted} stale rows.")
+    return deleted
@@ -1,12 +1,30 @@
 import os
+import time
 import json
-import traceback
+import asyncio
 import logging
+from functools import partial
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.exceptions import TelegramBadRequest
-from database import pool as ydb_pool
-import ydb
+import database
+import expiry
+import group_handlers
 import handlers
+import multiplayer
+import service
+from metrics import metrics
+from outbound import sender
+from state_store import get_store, store
+from middlewares import UpdateOrderingMiddleware, HandlerTimingMiddleware, TelegramTimingMiddleware
+
+# orjson разбирает тело апдейта в несколько раз быстрее json; необязательная зависимость
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 # Настройка базового логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -14,66 +32,255 @@ logger = logging.getLogger(__name__)
 
 # Создаем один раз при запуске
 dp = Dispatcher()
-# Роутеры включаются в диспетчер
+# Роутеры включаются в диспетчер; групповой квиз первым, он принимает только апдейты из групп.
+# Без него /group отвечает, что режим недоступен (handlers.cmd_group_unsupported)
+if multiplayer.GROUP_QUIZ_ENABLED:
+    dp.include_router(group_handlers.router)
+    group_handlers.router.message.middleware(HandlerTimingMiddleware())
+    group_handlers.router.callback_query.middleware(HandlerTimingMiddleware())
 dp.include_router(handlers.router) # handlers импортирован явно
+# Дедупликация по update_id и последовательная обработка апдейтов одного пользователя
+dp.update.outer_middleware(UpdateOrderingMiddleware())
+# Тайминги каждого хэндлера
+handlers.router.message.middleware(HandlerTimingMiddleware())
+handlers.router.callback_query.middleware(HandlerTimingMiddleware())
 
 API_TOKEN = os.getenv("API_TOKEN")
 if not API_TOKEN:
     logger.error("API_TOKEN environment variable not set!")
     raise ValueError("API_TOKEN environment variable not set!")
 
-bot = Bot(token=API_TOKEN)
+# TELEGRAM_API_URL позволяет направить бота на локальный Bot API сервер или заглушку для тестов
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+if TELEGRAM_API_URL:
+    bot = Bot(token=API_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=API_TOKEN)
+# Исходящие вызовы идут через очередь с лимитами Telegram, тайминги меряют уже сам вызов
+bot.session.middleware(sender)
+bot.session.middleware(TelegramTimingMiddleware())
+
+# Истекшие вопросы квиза на время обрабатывает хэндлер, которому нужен бот для отправки сообщений
+expiry.scheduler.handler = partial(handlers.expire_question, bot)
+multiplayer.round_scheduler.handler = partial(group_handlers.close_group_round, bot)
+
+# Сколько пользователей из одного пакета апдейтов обрабатываются одновременно
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "16"))
 
 logger.info("Bot and Dispatcher initialized.")
-logger.info(f"YDB Pool imported and ready: {ydb_pool is not None}")
 
+# Первый вызов в инстансе считается холодным стартом
+_cold_start = True
+# Тайминги вызовов отдельно для холодных и теплых стартов
+invocation_stats = {
+    'cold': {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0},
+    'warm': {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0},
+}
 
-async def process_event(event: dict):
+
+def _record_invocation(kind: str, elapsed_ms: float) -> None:
+    stats = invocation_stats[kind]
+    stats['count'] += 1
+    stats['total_ms'] += elapsed_ms
+    stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+    metrics.observe('invocation', kind, elapsed_ms / 1000)
+    metrics.maybe_log_snapshot()
+    connect_time = database.connection.connect_time
+    connect_info = f"{connect_time * 1000:.1f} ms" if connect_time is not None else "not connected"
+    logger.info(
+        f"Invocation took {elapsed_ms:.1f} ms ({kind} start, YDB connect: {connect_info}, "
+        f"avg {kind}: {stats['total_ms'] / stats['count']:.1f} ms over {stats['count']})."
+    )
+
+
+def _parse_body(body_str: str):
+    try:
+        with metrics.timer('webhook', 'json_parse'):
+            return _json_loads(body_str)
+    except ValueError as e:  # json.JSONDecodeError и orjson.JSONDecodeError
+        logger.error(f"Failed to parse JSON body: {body_str[:200]}...", exc_info=True)
+        raise ValueError("Некорректное тело запроса (не JSON)") from e
+
+
+def _extract_updates(event: dict) -> list[dict]:
     """
-    Processes a single incoming event from the webhook.
+    Returns the Telegram updates carried by the event.
+    Поддерживаются: один апдейт в теле, JSON-массив апдейтов и триггер Message Queue ('messages').
     """
-    log_event = event.copy()
-    if 'body' in log_event and isinstance(log_event['body'], str) and len(log_event['body']) > 500:
-        log_event['body'] = log_event['body'][:500] + '...'
-    logger.info(f"Received event: {json.dumps(log_event)}")
+    if 'messages' in event:
+        updates = []
+        for queue_message in event['messages']:
+            body_str = queue_message.get('details', {}).get('message', {}).get('body')
+            if not body_str:
+                logger.warning("Received queue message with no body.")
+                continue
+            body = _parse_body(body_str)
+            updates.extend(body if isinstance(body, list) else [body])
+        return updates
 
     body_str = event.get('body')
     if not body_str:
         logger.warning("Received event with no body.")
         raise ValueError("Нет тела запроса")
+    body = _parse_body(body_str)
+    return body if isinstance(body, list) else [body]
 
-    try:
-        event_body = json.loads(body_str)
-    except json.JSONDecodeError as e:
-        logger.error(f"Failed to parse JSON body: {body_str[:200]}...", exc_info=True)
-        raise ValueError("Некорректное тело запроса (не JSON)") from e
 
+def _is_timer_event(event: dict) -> bool:
+    # Таймер-триггер: периодический обход истекших вопросов квиза на время
+    return any(
+        queue_message.get('event_metadata', {}).get('event_type', '').endswith('TimerMessage')
+        for queue_message in event.get('messages', [])
+    )
+
+
+async def sweep_expired() -> int:
+    """Expires timed questions whose deadline passed while no instance was running to notice."""
+    ready_store = await get_store()
+    if ready_store is None:
+        logger.warning("Quiz state store is unavailable, expiry sweep skipped.")
+        return 0
+    return await expiry.sweep(ready_store, service.QUIZ_TIME_GRACE_MS)
+
+
+_used_update_types: frozenset[str] | None = None
+
+
+def _is_supported(event_body: dict) -> bool:
+    """
+    True if some router handles this update type (message, callback_query...).
+    Остальные апдейты (edited_message, my_chat_member и т.п.) отбрасываются до дорогой валидации pydantic.
+    """
+    global _used_update_types
+    if _used_update_types is None:
+        # Роутеры подключены при импорте, набор типов после этого не меняется
+        _used_update_types = frozenset(dp.resolve_used_update_types())
+    return any(update_type in event_body for update_type in _used_update_types)
+
+
+def _update_user_key(event_body: dict):
+    # Ключ группировки: id отправителя (message, callback_query и т.п.), иначе сам update_id
+    for value in event_body.values():
+        if isinstance(value, dict):
+            sender = value.get('from') or value.get('user')
+            if isinstance(sender, dict) and 'id' in sender:
+                return sender['id']
+    return ('update', event_body.get('update_id'))
+
+
+async def process_update(event_body: dict):
+    """
+    Validates a single Telegram update and feeds it to the dispatcher.
+    """
     try:
-        # Хэндлеры используют глобальный импортированный pool
-        update = types.Update.model_validate(event_body, context={"bot": bot}) 
-        await dp.feed_update(bot, update)
-        logger.info("Event processed successfully.")
+        # Хэндлеры получают хранилище состояний через state_store.get_store()
+        with metrics.timer('webhook', 'model_validate'):
+            update = types.Update.model_validate(event_body, context={"bot": bot}) 
+        with metrics.timer('webhook', 'feed_update'):
+            await dp.feed_update(bot, update)
     except TelegramBadRequest as e:
         logger.warning(f"Telegram API bad request: {e}", exc_info=True)
         pass # Считаем обработку успешной для Telegram
 
     except Exception as e:
-        logger.error("Error processing update:", exc_info=True)
+        logger.error(f"Error processing update {event_body.get('update_id')}:", exc_info=True)
         raise # Пробрасываем исключение выше
 
 
+async def _prefetch_states(user_ids: list[int]) -> None:
+    """Reads the states of the batch's users into the cache with one query instead of one per user."""
+    if not user_ids or not service.state_cache.enabled:
+        return
+    ready_store = await get_store()
+    if ready_store is None:
+        return
+    try:
+        with metrics.timer('webhook', 'prefetch_states'):
+            await service.load_states(ready_store, user_ids)
+    except Exception as e:
+        # Не критично: хэндлеры прочитают состояния по одному
+        logger.warning(f"Failed to prefetch quiz states of {len(user_ids)} users: {e}")
+
+
+async def process_batch(updates: list[dict]):
+    """
+    Processes many updates: sequentially within one user, concurrently across users.
+    Raises after the whole batch has been processed if any update failed.
+    """
+    groups: dict = {}
+    for event_body in updates:
+        groups.setdefault(_update_user_key(event_body), []).append(event_body)
+
+    await _prefetch_states([key for key in groups if isinstance(key, int)])
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def process_group(group: list[dict]) -> int:
+        failed = 0
+        async with semaphore:
+            for event_body in group:
+                try:
+                    await process_update(event_body)
+                except Exception:
+                    failed += 1
+        return failed
+
+    failed = sum(await asyncio.gather(*(process_group(group) for group in groups.values())))
+    logger.info(f"Batch of {len(updates)} updates from {len(groups)} users processed, {failed} failed.")
+    if failed:
+        raise RuntimeError(f"{failed} of {len(updates)} updates failed")
+
+
+async def process_event(event: dict):
+    """
+    Processes an incoming event from the webhook or a message queue trigger.
+    """
+    # Полное событие пишем только на DEBUG: сериализация на каждом запросе заметна при высокой нагрузке
+    if logger.isEnabledFor(logging.DEBUG):
+        log_event = event.copy()
+        if 'body' in log_event and isinstance(log_event['body'], str) and len(log_event['body']) > 500:
+            log_event['body'] = log_event['body'][:500] + '...'
+        logger.debug(f"Received event: {json.dumps(log_event)}")
+
+    if _is_timer_event(event):
+        await sweep_expired()
+        logger.info("Timer event processed successfully.")
+        return
+
+    updates = _extract_updates(event)
+    supported = [event_body for event_body in updates if _is_supported(event_body)]
+    if len(supported) < len(updates):
+        logger.debug(f"Skipped {len(updates) - len(supported)} updates of types without handlers.")
+    updates = supported
+    if not updates:
+        logger.info("Event has no updates to process.")
+        return
+    if len(updates) == 1:
+        await process_update(updates[0])
+    else:
+        await process_batch(updates)
+    logger.info("Event processed successfully.")
+
+
 async def webhook(event: dict, context: object) -> dict:
     """
     Entry point for the Yandex Cloud Function.
-    Handles incoming HTTP requests from Telegram webhook.
+    Handles incoming HTTP requests from Telegram webhook and Message Queue trigger events.
     """
-    if event and event.get('httpMethod') == 'POST':
+    global _cold_start
+    if event and (event.get('httpMethod') == 'POST' or 'messages' in event):
+        started = time.perf_counter()
+        kind = 'cold' if _cold_start else 'warm'
+        _cold_start = False
+        # Подключение к хранилищу идет в фоне, параллельно с разбором апдейта
+        store.start()
         try:
             await process_event(event)
             return {'statusCode': 200, 'body': 'ok'}
         except Exception:
             # process_event уже залогировал специфичные ошибки
             return {'statusCode': 500}
+        finally:
+            _record_invocation(kind, (time.perf_counter() - started) * 1000)
     else:
         method = event.get('httpMethod', 'UNKNOWN') if event else 'None'
         logger.warning(f"Received non-POST request (method: {method}). Returning 405.")
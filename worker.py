@@ -0,0 +1,150 @@
+import os
+
+# Процесс живет постоянно, и таймер сброса кэша работает: ответы пишутся в хранилище пачками.
+# Задается до импорта service, где читается настройка (в облачной функции по умолчанию запись на каждый ответ)
+os.environ.setdefault("QUIZ_STATE_FLUSH_EVERY", "5")
+# Статистику ответов тоже можно копить: остаток дописывается в on_shutdown
+os.environ.setdefault("ANSWER_STATS_FLUSH_EVERY", "50")
+# Раунды группового квиза закрывает таймер процесса: режим работает только здесь
+os.environ.setdefault("GROUP_QUIZ_ENABLED", "1")
+
+import asyncio
+import logging
+import argparse
+from aiohttp import web
+import database
+import service
+import results
+from state_store import QUIZ_STATE_BACKEND, cleanup_stale, get_store, store
+from metrics import metrics
+from tb_webhook import bot, dp, process_event, sweep_expired
+
+# Долгоживущий процесс: один теплый пул YDB и общие кэши на все апдейты.
+# Запуск: python worker.py --mode polling  или  python worker.py --mode webhook --port 8080
+logger = logging.getLogger(__name__)
+
+WORKER_MODE = os.getenv("WORKER_MODE", "polling")
+WORKER_HOST = os.getenv("WORKER_HOST", "0.0.0.0")
+WORKER_PORT = int(os.getenv("WORKER_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Вопросы, отправленные этим процессом, истекают по таймеру в памяти (expiry.scheduler).
+# Обход хранилища раз в интервал подбирает отсчеты, начатые до перезапуска или другим инстансом
+EXPIRY_SWEEP_INTERVAL = float(os.getenv("EXPIRY_SWEEP_INTERVAL", "30"))
+# Очистка брошенных quiz_state, секунд между проходами (0 - выключена).
+# В YDB строки удаляет TTL и ручного обхода нет, поэтому там по умолчанию очистка выключена
+QUIZ_STATE_CLEANUP_INTERVAL = float(os.getenv("QUIZ_STATE_CLEANUP_INTERVAL", "0" if QUIZ_STATE_BACKEND == "ydb" else "3600"))
+
+_sweep_task: asyncio.Task | None = None
+_cleanup_task: asyncio.Task | None = None
+
+
+async def _sweep_loop() -> None:
+    while True:
+        try:
+            await sweep_expired()
+        except Exception:
+            logger.error("Expiry sweep failed.", exc_info=True)
+        await asyncio.sleep(EXPIRY_SWEEP_INTERVAL)
+
+
+async def _cleanup_loop() -> None:
+    while True:
+        await asyncio.sleep(QUIZ_STATE_CLEANUP_INTERVAL)
+        try:
+            ready_store = await get_store()
+            if ready_store is not None:
+                await cleanup_stale(ready_store)
+        except Exception:
+            logger.error("Quiz state cleanup failed.", exc_info=True)
+
+
+async def on_startup() -> None:
+    # Прогреваем подключение к хранилищу до первого апдейта
+    global _sweep_task, _cleanup_task
+    ready = await store.ready()
+    logger.info(f"Worker started, quiz state store ({type(store).__name__}) ready: {ready}")
+    _sweep_task = asyncio.get_running_loop().create_task(_sweep_loop())
+    if QUIZ_STATE_CLEANUP_INTERVAL > 0:
+        _cleanup_task = asyncio.get_running_loop().create_task(_cleanup_loop())
+
+
+async def on_shutdown() -> None:
+    """
+    Flushes cached quiz state and closes the store, YDB and Telegram sessions.
+    """
+    logger.info("Worker is shutting down.")
+    for task in (_sweep_task, _cleanup_task):
+        if task is not None:
+            task.cancel()
+    try:
+        ready_store = await get_store()
+        if ready_store is not None:
+            await service.flush_all(ready_store)
+        await results.flush_answer_stats()
+    except Exception:
+        logger.error("Failed to flush quiz state on shutdown.", exc_info=True)
+    await store.close()
+    await database.connection.close()
+    await bot.session.close()
+
+
+async def handle_webhook(request: web.Request) -> web.Response:
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        logger.warning("Rejected webhook request with invalid secret token.")
+        return web.Response(status=403)
+    # Та же обработка, что и в облачной функции: батчи, группировка по пользователям
+    event = {'httpMethod': 'POST', 'body': await request.text()}
+    try:
+        await process_event(event)
+    except Exception:
+        return web.Response(status=500)
+    return web.Response(text='ok')
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    # Гистограммы задержек в текстовом формате Prometheus
+    return web.Response(text=metrics.render_prometheus(), content_type='text/plain', charset='utf-8')
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    app.router.add_get('/metrics', handle_metrics)
+
+    async def startup(_: web.Application) -> None:
+        await on_startup()
+
+    async def shutdown(_: web.Application) -> None:
+        await on_shutdown()
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    return app
+
+
+async def run_polling() -> None:
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    # Polling не работает при установленном вебхуке
+    await bot.delete_webhook(drop_pending_updates=False)
+    # start_polling сам обрабатывает SIGINT/SIGTERM и вызывает dp.shutdown
+    await dp.start_polling(bot)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Persistent quiz bot worker")
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default=WORKER_MODE)
+    parser.add_argument('--host', default=WORKER_HOST)
+    parser.add_argument('--port', type=int, default=WORKER_PORT)
+    args = parser.parse_args()
+
+    if args.mode == 'polling':
+        asyncio.run(run_polling())
+    else:
+        # run_app корректно завершает приложение по SIGINT/SIGTERM
+        web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()